@@ -2,10 +2,13 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
+import os
 import numpy as np
 import pyaudio
+import scipy.io.wavfile
+import threading
 import time
-from audioled.effects import Effect
+from audioled.effects import Effect, BufferSpec
 
 
 def print_audio_devices():
@@ -32,9 +35,212 @@ def numInputChannels(device_index=None):
     return info['maxInputChannels']
 
 
+def load_audio_file(path, sample_rate=None, num_channels=1):
+    """Loads audio samples from a file without reading it into memory
+
+    Supported formats:
+    - .wav files, integer samples are kept as they are and scaled by file_audio_chunks
+    - .npy files with an array of shape (frames,) or (frames, channels), sample_rate is required
+    - raw interleaved float32 samples (any other extension), sample_rate and num_channels are required
+
+    Returns
+    -------
+    samples: numpy.ndarray of shape (frames, channels), memory-mapped where possible
+    sample_rate: int
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.wav':
+        sample_rate, samples = scipy.io.wavfile.read(path, mmap=True)
+    elif ext == '.npy':
+        samples = np.load(path, mmap_mode='r')
+    else:
+        samples = np.memmap(path, dtype=np.float32, mode='r')
+        samples = samples[:len(samples) - len(samples) % num_channels].reshape(-1, num_channels)
+    if sample_rate is None:
+        raise ValueError("Sample rate of {} is unknown".format(path))
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+    return samples, int(sample_rate)
+
+
+def file_audio_chunks(samples, sample_rate, chunk_rate=60, channels=1, clock=None, loop=False):
+    """Generates float32 audio chunks of shape (chunk_length, channels) from samples of shape (frames, channels)
+
+    Chunks have the same size and layout as chunks read from an audio device,
+    the same array is reused for every chunk.
+    Without a clock, consecutive chunks are returned. With a clock (a function returning
+    the time in seconds), chunks are returned like from a device that is read at that time:
+    None until the next chunk is complete, and a reader that fell two chunks behind
+    skips to the latest chunk.
+    Missing channels are filled with the last channel of the samples.
+    Integer samples are scaled to [-1, 1) one chunk at a time.
+    Stops at the end of the samples unless loop is True.
+    """
+    chunk_length = int(sample_rate // chunk_rate)
+    num_frames = len(samples)
+    channel_index = [min(i, samples.shape[1] - 1) for i in range(0, channels)]
+    chunk = np.zeros((chunk_length, channels), dtype=np.float32)
+    offset, scale = 0.0, 1.0
+    if np.issubdtype(samples.dtype, np.integer):
+        info = np.iinfo(samples.dtype)
+        offset, scale = (info.max + 1 + info.min) / 2, 2 / (info.max - info.min + 1)
+    position = 0
+    while True:
+        if clock is not None:
+            captured = int(clock() * sample_rate)
+            if captured - position < chunk_length:
+                yield None
+                continue
+            if captured - position >= 2 * chunk_length:
+                position = captured - chunk_length
+        if position + chunk_length > num_frames and not loop:
+            return
+        start = position % num_frames
+        if start + chunk_length <= num_frames:
+            chunk[:] = samples[start:start + chunk_length, channel_index]
+        else:
+            # wrap around
+            indices = np.arange(start, start + chunk_length) % num_frames
+            chunk[:] = samples[indices][:, channel_index]
+        if scale != 1.0:
+            chunk -= offset
+            chunk *= scale
+        position += chunk_length
+        yield chunk
+
+
+class AudioRingBuffer(object):
+    """Preallocated ring buffer of float32 audio frames of shape (frames, channels)
+
+    The writer thread and the reader threads don't need a lock: the writer publishes
+    the number of written frames after copying the data and readers only copy
+    published frames. Every reader has its own read position, see reader().
+    The buffer has to be large enough that the writer doesn't wrap around while a reader copies.
+    """
+    def __init__(self, num_frames, channels):
+        self.channels = channels
+        self._data = np.zeros((num_frames, channels), dtype=np.float32)
+        self._written = 0
+        # input overflows reported by the device
+        self.overflowCount = 0
+        # reads without a full chunk of new frames
+        self.underrunCount = 0
+
+    def write(self, frames):
+        size = len(self._data)
+        frames = frames[-size:]
+        n = len(frames)
+        start = self._written % size
+        first = min(n, size - start)
+        self._data[start:start + first] = frames[:first]
+        self._data[:n - first] = frames[first:]
+        self._written += n
+
+    def reader(self):
+        """Returns an AudioRingReader starting with the next written frame"""
+        return AudioRingReader(self)
+
+
+class AudioRingReader(object):
+    """Reads consecutive chunks from an AudioRingBuffer, every frame is read at most once"""
+    def __init__(self, ring):
+        self.ring = ring
+        self._read = ring._written
+
+    def read(self, out):
+        """Copies the next len(out) unread frames into out
+
+        Returns False and leaves out untouched if less than len(out) frames are unread.
+        A reader that fell two chunks behind skips to the latest len(out) frames,
+        so the delay stays below two chunks.
+        """
+        n = len(out)
+        written = self.ring._written
+        if written - self._read < n:
+            self.ring.underrunCount += 1
+            return False
+        if written - self._read >= 2 * n:
+            self._read = written - n
+        data = self.ring._data
+        size = len(data)
+        start = self._read % size
+        first = min(n, size - start)
+        out[:first] = data[start:start + first]
+        out[first:] = data[:n - first]
+        self._read += n
+        return True
+
+
+class AudioCapture(object):
+    """Captures audio from an input device into an AudioRingBuffer
+
+    PyAudio's callback mode writes the audio from its own thread,
+    so reading never waits for the device.
+    """
+    def __init__(self, device_index, channels, chunk_rate, num_chunks=16):
+        self.device_index = device_index
+        self.channels = channels
+        self.chunk_rate = chunk_rate
+        self._pyaudio = pyaudio.PyAudio()
+        print("Using audio device {}".format(device_index))
+        device_info = self._pyaudio.get_device_info_by_index(device_index)
+        if device_info['maxInputChannels'] == 0:
+            self._pyaudio.terminate()
+            err = 'Your audio input device cannot be opened. '
+            err += 'Change default audio device or try a different device index. '
+            err += 'Device info:\n{}'.format(device_info)
+            raise OSError(err)
+        self.sample_rate = int(device_info['defaultSampleRate'])
+        self.chunk_length = int(self.sample_rate // chunk_rate)
+        self.ring = AudioRingBuffer(num_chunks * self.chunk_length, channels)
+        # number of chunk generators reading the ring, see AudioInput.stream_audio
+        self.readers = 0
+        self._stream = self._open_stream(device_info)
+
+    def _open_stream(self, device_info, retry=0):
+        try:
+            return self._pyaudio.open(format=pyaudio.paFloat32,
+                                      channels=self.channels,
+                                      rate=self.sample_rate,
+                                      input=True,
+                                      input_device_index=self.device_index,
+                                      frames_per_buffer=0,
+                                      stream_callback=self._callback)
+        except OSError as e:
+            if retry == 5:
+                err = 'Error occurred while attempting to open audio device. '
+                err += 'Check your operating system\'s audio device configuration. '
+                err += 'Audio device information: \n'
+                err += str(device_info)
+                print(err)
+                self._pyaudio.terminate()
+                raise e
+            time.sleep(retry)
+            return self._open_stream(device_info, retry=retry + 1)
+
+    def _callback(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & pyaudio.paInputOverflow:
+            self.ring.overflowCount += 1
+        self.ring.write(np.frombuffer(in_data, dtype=np.float32).reshape(-1, self.channels))
+        return (None, pyaudio.paContinue)
+
+    def close(self):
+        self._stream.stop_stream()
+        self._stream.close()
+        self._pyaudio.terminate()
+
+
 class AudioInput(Effect):
     overrideDeviceIndex = None
-    global_stream = None
+    # function(chunk_rate, channels) returning (chunk generator, sample rate)
+    # to use instead of the audio device, e.g. for offline rendering.
+    # Chunks are float32 arrays of shape (chunk_length, channels),
+    # the outputs of audio inputs are strided views of the channels
+    overrideSource = None
+    # AudioCaptures shared by all inputs with the same (device index, channels, chunk rate),
+    # a capture is closed when its last reader is closed
+    global_streams = {}
+    _streamsLock = threading.Lock()
     """
     Outputs:
     0: Audio Channel 0
@@ -51,11 +257,18 @@ class AudioInput(Effect):
 
     def __initstate__(self):
         super(AudioInput, self).__initstate__()
+        previousStream = getattr(self, '_audioStream', None)
         deviceIndex = self.device_index
         if self.overrideDeviceIndex is not None:
             deviceIndex = self.overrideDeviceIndex
-        self._audioStream, self._sampleRate = self.stream_audio(chunk_rate=self.chunk_rate, channels=self.num_channels, device_index=deviceIndex)
-        self._buffer = []
+        if AudioInput.overrideSource is not None:
+            self._audioStream, self._sampleRate = AudioInput.overrideSource(chunk_rate=self.chunk_rate, channels=self.num_channels)
+        else:
+            self._audioStream, self._sampleRate = self.stream_audio(chunk_rate=self.chunk_rate, channels=self.num_channels, device_index=deviceIndex)
+        # release the previous reader after opening the new one, so an unchanged configuration keeps its capture
+        if hasattr(previousStream, 'close'):
+            previousStream.close()
+        self._buffer = None
         self._chunk_size = int(self._sampleRate / self.chunk_rate)
         # increase cur_gain by percentage
         # we want to get to self.autogain_max in approx. self.autogain_time seconds
@@ -66,51 +279,14 @@ class AudioInput(Effect):
         self._autogain_perc = (1.0 / min_value)**float(1 / N)
         self._cur_gain = 1.0
 
-    def _open_input_stream(self, device_index=None, channels=1, retry=0):
-        """Opens a PyAudio audio input stream
+    def stream_audio(self, chunk_rate=60, ignore_overflows=True, device_index=None, channels=1):
+        """Returns a generator of audio chunks of the input device and the sample rate
 
-        Parameters
-        ----------
-        device_index: int, optional
-            Device index for the PyAudio audio input stream.
-            If device index is not specified then the default audio device
-            will be opened.
+        Audio is captured in the background, see AudioCapture. The generator doesn't block,
+        it returns the next chunk_length frames as float32 array of shape (chunk_length, channels),
+        or None if no full chunk has been captured since the last one.
+        The same array is reused for every chunk.
         """
-        p = pyaudio.PyAudio()
-        defaults = p.get_default_host_api_info()
-
-
-
-        print("Using audio device {}".format(device_index))
-        device_info = p.get_device_info_by_index(device_index)
-
-        if device_info['maxInputChannels'] == 0:
-            err = 'Your audio input device cannot be opened. '
-            err += 'Change default audio device or try a different device index. '
-            err += 'Device info:\n{}\n{}'.format(defaults, device_info)
-            raise OSError(err)
-
-        try:
-            stream = p.open(format=pyaudio.paFloat32,
-                            channels=channels,
-                            rate=int(device_info['defaultSampleRate']),
-                            input=True,
-                            input_device_index=device_index,
-                            frames_per_buffer=0)
-        except OSError as e:
-            if retry==5:
-                err = 'Error occurred while attempting to open audio device. '
-                err += 'Check your operating system\'s audio device configuration. '
-                err += 'Audio device information: \n'
-                err += str(device_info)
-                print(err)
-                raise e
-            time.sleep(retry)
-            return self._open_input_stream(device_index=device_index, channels=channels, retry=retry+1)
-        return stream, int(device_info['defaultSampleRate'])
-
-
-    def stream_audio(self, chunk_rate=60, ignore_overflows=True, device_index=None, channels=1):
         if device_index is None:
             print("No device_index for audio given. Using default.")
             p = pyaudio.PyAudio()
@@ -121,38 +297,70 @@ class AudioInput(Effect):
                 err = 'No default audio device configured. '
                 err += 'Change default audio device or supply a specific device index. '
                 raise OSError(err)
-        # Get samplerate for device
-        p = pyaudio.PyAudio()
-        device_info = p.get_device_info_by_index(device_index)
-        samplerate = int(device_info['defaultSampleRate'])
-
-        chunk_length = int(samplerate // chunk_rate)
+        # the stream is shared by all inputs using the same device and configuration,
+        # each input reads all frames
+        key = (device_index, channels, chunk_rate)
+        with AudioInput._streamsLock:
+            capture = AudioInput.global_streams.get(key)
+            if capture is None:
+                capture = AudioCapture(device_index, channels, chunk_rate)
+                AudioInput.global_streams[key] = capture
+            capture.readers += 1
 
         def audio_chunks():
-            fs = samplerate
-            while True:
-                try:
-                    if AudioInput.global_stream is None:
-                        AudioInput.global_stream, fs = self._open_input_stream(device_index, channels=channels)
-
-                    chunk = AudioInput.global_stream.read(chunk_length)
-                except IOError as e:
-                    if e.errno == pyaudio.paInputOverflowed:
+            try:
+                reader = capture.ring.reader()
+                chunk = np.zeros((capture.chunk_length, channels), dtype=np.float32)
+                overflows = capture.ring.overflowCount
+                yield None
+                while True:
+                    hasChunk = reader.read(chunk)
+                    if capture.ring.overflowCount > overflows:
+                        overflows = capture.ring.overflowCount
                         print('Audio buffer full')
-                        if ignore_overflows:
-                            AudioInput.global_stream, fs = self._open_input_stream(device_index, channels=channels)
-                            continue
-                        else:
-                            raise e
-                chunk = np.fromstring(chunk, np.float32).astype(np.float)
-                yield chunk
-        return audio_chunks(), samplerate
+                        if not ignore_overflows:
+                            raise IOError('Audio input overflowed')
+                    yield chunk if hasChunk else None
+            finally:
+                AudioInput._releaseCapture(key, capture)
 
+        chunks = audio_chunks()
+        # start the generator, so closing it runs the finally block and releases the capture
+        next(chunks)
+        return chunks, capture.sample_rate
+
+    @staticmethod
+    def _releaseCapture(key, capture):
+        with AudioInput._streamsLock:
+            capture.readers -= 1
+            if capture.readers > 0 or AudioInput.global_streams.get(key) is not capture:
+                return
+            del AudioInput.global_streams[key]
+        capture.close()
+
+    @staticmethod
+    def close_streams():
+        """Closes all audio captures, e.g. on shutdown"""
+        with AudioInput._streamsLock:
+            captures = list(AudioInput.global_streams.values())
+            AudioInput.global_streams.clear()
+        for capture in captures:
+            capture.close()
+
+    def close(self):
+        """Closes the audio stream of this input, the capture is closed with its last reader"""
+        stream = getattr(self, '_audioStream', None)
+        self._audioStream = None
+        if hasattr(stream, 'close'):
+            stream.close()
 
 
     def numOutputChannels(self):
         return self.num_channels
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((self._chunk_size,), np.float32) for i in range(0, self.num_channels)]
+
     def numInputChannels(self):
         return 0
 
@@ -181,9 +389,15 @@ class AudioInput(Effect):
 
     async def update(self, dt):
         await super(AudioInput, self).update(dt)
-        self._buffer = next(self._audioStream)
+        # None when no chunk is available or the source ended
+        self._buffer = next(self._audioStream, None)
 
     def process(self):
+        if self._buffer is None:
+            # no new audio, consumers hold their outputs
+            for i in range(0, self.num_channels):
+                self._outputBuffer[i] = None
+            return
         if self.autogain:
             # determine max value -> in range 0,1
             maxVal = np.max(self._buffer)
@@ -193,8 +407,103 @@ class AudioInput(Effect):
             elif self._cur_gain < self.autogain_max:
                 self._cur_gain = min(self.autogain_max, self._cur_gain * self._autogain_perc)
             # print("cur_gain: {}, gained value: {}".format(self._cur_gain, self._cur_gain * maxVal))
+        if self._cur_gain != 1.0:
+            # chunks are reused by the stream, gain can be applied in place
+            np.multiply(self._buffer, self._cur_gain, out=self._buffer)
+        for i in range(0, self.num_channels):
+            self._outputBuffer[i] = self._buffer[:, i]
+
+
+class FileAudioInput(Effect):
+    """
+    Audio source reading from an audio file or a numpy array instead of an audio device,
+    see load_audio_file for supported files.
+
+    In realtime mode chunks follow the time of the filter graph, like an audio device.
+    Otherwise a new chunk is read on every update, as fast as the graph runs.
+
+    Outputs:
+    0: Audio Channel 0
+    1: Audio Channel 1...
+    """
+    def __init__(self, path=None, chunk_rate=60, num_channels=2, sample_rate=None, realtime=True, loop=True):
+        self.path = path
+        self.chunk_rate = chunk_rate
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.realtime = realtime
+        self.loop = loop
+        self.__initstate__()
+
+    def __initstate__(self):
+        super(FileAudioInput, self).__initstate__()
+        try:
+            self._samples
+        except AttributeError:
+            self._samples = None
+            self._sampleRate = self.sample_rate
+        self._buffer = None
+        self._audioStream = None
+        if self.path is not None:
+            self._samples, self._sampleRate = load_audio_file(self.path, self.sample_rate, self.num_channels)
+        if self._samples is not None:
+            self._startStream()
+
+    def setSamples(self, samples, sample_rate):
+        """Uses samples of shape (frames,) or (frames, channels) instead of the file"""
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        self.path = None
+        self._samples = samples
+        self._sampleRate = int(sample_rate)
+        self._startStream()
+
+    def _startStream(self):
+        self._chunk_size = int(self._sampleRate // self.chunk_rate)
+        clock = (lambda: self._t) if self.realtime else None
+        self._audioStream = file_audio_chunks(self._samples, self._sampleRate, self.chunk_rate, self.num_channels, clock=clock, loop=self.loop)
+
+    def numOutputChannels(self):
+        return self.num_channels
+
+    def numInputChannels(self):
+        return 0
+
+    def inferOutputSpecs(self, inputSpecs):
+        if self._samples is None:
+            return [None for i in range(0, self.num_channels)]
+        return [BufferSpec((self._chunk_size,), np.float32) for i in range(0, self.num_channels)]
+
+    @staticmethod
+    def getParameterDefinition():
+        definition = {
+            "parameters": {
+                "realtime": True,
+                "loop": True,
+            }
+        }
+        return definition
+
+    def getParameter(self):
+        definition = self.getParameterDefinition()
+        definition['parameters']['realtime'] = self.realtime
+        definition['parameters']['loop'] = self.loop
+        return definition
+
+    def getSampleRate(self):
+        return self._sampleRate
+
+    async def update(self, dt):
+        await super(FileAudioInput, self).update(dt)
+        if self._audioStream is None:
+            return
+        # silence at the end of the file
+        self._buffer = next(self._audioStream, None)
+
+    def process(self):
         for i in range(0, self.num_channels):
-            # layout for multiple channel is interleaved:
-            # 00 01 .. 0n 10 11 .. 1n
-            self._outputBuffer[i] = self._cur_gain * self._buffer[i::self.num_channels]
-            #print("{}: {}".format(i, self._outputBuffer[i]))
+            if self._buffer is None:
+                self._outputBuffer[i] = None
+            else:
+                self._outputBuffer[i] = self._buffer[:, i]
@@ -10,13 +10,109 @@ import time
 
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d
-from scipy.signal import lfilter
 import matplotlib as mpl
 
 import audioled.dsp as dsp
 import audioled.colors as colors
 import audioled.filtergraph as filtergraph
-from audioled.effects import Effect
+from audioled.effects import Effect, BufferSpec
+
+
+class SpectrumAnalyzer(Effect):
+    """
+    SpectrumAnalyzer performs the FFT of the audio once per chunk and provides the power spectrum
+    and the bass and melody bands to any number of spectrum based effects.
+
+    Inputs:
+    - 0: Audio
+
+    Outputs:
+    - 0: Power spectrum
+    - 1: Bass bands (bark scale, 32.7 Hz to 261 Hz)
+    - 2: Melody bands (bark scale, 261 Hz to fmax)
+
+    """
+
+    def __init__(self, fs, fmax=6000, n_overlaps=4, fft_bins=64):
+        self.fs = fs
+        self.fmax = fmax
+        self.n_overlaps = n_overlaps
+        self.fft_bins = fft_bins
+        self.__initstate__()
+
+    def __initstate__(self):
+        # state
+        self._fs_ds = 0.0
+        self._lastAudioChunk = None
+        self._gen = None
+        self._psd = None
+        super(SpectrumAnalyzer, self).__initstate__()
+
+    def numInputChannels(self):
+        return 1
+
+    def numOutputChannels(self):
+        return 3
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        bands = BufferSpec((self.fft_bins,))
+        if inputSpecs[0] is None:
+            return [None, bands, bands]
+        return [BufferSpec((self._fftLength(inputSpecs[0].shape[0]) // 2 + 1,)), bands, bands]
+
+    @staticmethod
+    def getParameterDefinition():
+        definition = {
+            "parameters": {
+                # default, min, max, stepsize
+                "fs": [48000, 44100, 96000, 100],
+                "fmax": [6000, 1000, 20000, 100],
+                "n_overlaps": [4, 1, 20, 1],
+                "fft_bins": [64, 32, 128, 1],
+            }
+        }
+        return definition
+
+    def getParameter(self):
+        definition = self.getParameterDefinition()
+        del definition['parameters']['fs'] # disable edit
+        definition['parameters']['fmax'][0] = self.fmax
+        definition['parameters']['n_overlaps'][0] = self.n_overlaps
+        definition['parameters']['fft_bins'][0] = self.fft_bins
+        return definition
+
+    def _fftLength(self, chunk_length):
+        # see dsp.preprocess: decimation, rolling window and zero padding
+        n = int(self.fs / (2 * self.fmax))
+        window = len(range(0, chunk_length, max(n, 1))) * self.n_overlaps
+        return int(2**np.ceil(np.log2(window)))
+
+    def buffer_coroutine(self):
+        while True:
+            yield self._lastAudioChunk
+
+    def process(self):
+        if self._inputBuffer is None or self._outputBuffer is None:
+            return
+        audio = self._inputBuffer[0]
+        if audio is None:
+            # no new audio, don't repeat the last spectrum
+            for i in range(0, 3):
+                self._outputBuffer[i] = None
+            return
+        self._lastAudioChunk = audio
+        if self._gen is None:
+            g = self.buffer_coroutine()
+            next(g)
+            self._gen, self._fs_ds = dsp.preprocess(g, self.fs, self.fmax, self.n_overlaps)
+        y = next(self._gen)
+        if self._psd is None or self._psd.n_fft != len(y):
+            self._psd = dsp.PowerSpectrum(len(y))
+        spectrum = self._psd.compute(y)
+        self._outputBuffer[0] = spectrum
+        self._outputBuffer[1] = dsp.warp_psd(spectrum, len(y), self.fft_bins, self._fs_ds, [32.7, 261.0], 'bark')
+        self._outputBuffer[2] = dsp.warp_psd(spectrum, len(y), self.fft_bins, self._fs_ds, [261.0, self.fmax], 'bark')
 
 
 class Spectrum(Effect):
@@ -27,6 +123,10 @@ class Spectrum(Effect):
     - 0: Audio
     - 1: Color for melody (default: white)
     - 2: Color for bass (default: white)
+    - 3: Bass bands from SpectrumAnalyzer (optional)
+    - 4: Melody bands from SpectrumAnalyzer (optional)
+
+    If both bands are connected, the bands are used instead of analyzing the audio input.
 
     Outputs:
     - 0: Pixel array
@@ -55,14 +155,23 @@ class Spectrum(Effect):
         self._melody_rms = None
         self._lastAudioChunk = None
         self._gen = None
+        self._psd = None
         super(Spectrum, self).__initstate__()
 
     def numInputChannels(self):
-        return 3
+        return 5
 
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        self._checkPixelSpec(inputSpecs, 1, self.num_pixels)
+        self._checkPixelSpec(inputSpecs, 2, self.num_pixels)
+        self._checkVectorSpec(inputSpecs, 3, 'a spectrum')
+        self._checkVectorSpec(inputSpecs, 4, 'a spectrum')
+        return [BufferSpec((3, self.num_pixels), np.int_)]
+
     @staticmethod
     def getParameterDefinition():
         definition = {
@@ -111,7 +220,11 @@ class Spectrum(Effect):
             if col_bass is None:
                 # default color: all white
                 col_bass = np.ones(self.num_pixels) * np.array([[255.0],[255.0],[255.0]])
-            if audio is not None:
+            bass = self._inputBuffer[3]
+            melody = self._inputBuffer[4]
+            if bass is None or melody is None:
+                if audio is None:
+                    return
                 if self._gen is None:
                     g = self.buffer_coroutine()
                     next(g)
@@ -119,12 +232,15 @@ class Spectrum(Effect):
                     self._gen = self._audio_gen(g)
                 self._lastAudioChunk = audio
                 y = next(self._gen)
-                bass = dsp.warped_psd(y, self.fft_bins, self._fs_ds, [32.7, 261.0], 'bark')
-                melody = dsp.warped_psd(y, self.fft_bins, self._fs_ds, [261.0, self.fmax], 'bark')
-                bass = self.process_line(bass, self._bass_rms)
-                melody = self.process_line(melody, self._melody_rms)
-                pixels = colors.blend(1./255.0 * np.multiply(col_bass, bass ), 1./255. * np.multiply(col_melody, melody), self.col_blend)
-                self._outputBuffer[0] = pixels.clip(0,255).astype(int)
+                if self._psd is None or self._psd.n_fft != len(y):
+                    self._psd = dsp.PowerSpectrum(len(y))
+                spectrum = self._psd.compute(y)
+                bass = dsp.warp_psd(spectrum, len(y), self.fft_bins, self._fs_ds, [32.7, 261.0], 'bark')
+                melody = dsp.warp_psd(spectrum, len(y), self.fft_bins, self._fs_ds, [261.0, self.fmax], 'bark')
+            bass = self.process_line(bass, self._bass_rms)
+            melody = self.process_line(melody, self._melody_rms)
+            pixels = colors.blend(1./255.0 * np.multiply(col_bass, bass ), 1./255. * np.multiply(col_melody, melody), self.col_blend)
+            self._outputBuffer[0] = pixels.clip(0,255).astype(int)
 
     def process_line(self, fft, fft_rms):
 
@@ -136,6 +252,8 @@ class Spectrum(Effect):
         #fft = np.tanh(fft / np.max(fft_rms)) * 255
 
         # Upsample to number of pixels
+        if len(fft) != len(self._fft_dist):
+            self._fft_dist = np.linspace(0, 1, len(fft))
         fft = np.interp(self._norm_dist, self._fft_dist, fft)
 
         #
@@ -187,6 +305,14 @@ class VUMeterRMS(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        self._checkPixelSpec(inputSpecs, 1)
+        color = inputSpecs[1]
+        if color is not None and 1 < color.shape[1] < self.num_pixels:
+            raise ValueError("Input 1 expects at least {} pixels, got {}".format(self.num_pixels, color.shape[1]))
+        return [BufferSpec((3, self.num_pixels))]
+
     @staticmethod
     def getParameterDefinition():
         definition = {
@@ -212,7 +338,7 @@ class VUMeterRMS(Effect):
             return
         buffer = self._inputBuffer[0]
         if buffer is None:
-            self._outputBuffer[0] = None
+            # no new audio, hold the meter
             return
         color = self._inputBuffer[1]
         if color is None:
@@ -252,6 +378,7 @@ class VUMeterPeak(Effect):
 
     def __initstate__(self):
         super().__initstate__()
+        self._checkColorSize()
         try:
             self._hold_values
             self._default_color
@@ -286,6 +413,19 @@ class VUMeterPeak(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        self._checkPixelSpec(inputSpecs, 1)
+        return [BufferSpec((3, self.num_pixels))]
+
+    def setInputSpecs(self, inputSpecs):
+        super(VUMeterPeak, self).setInputSpecs(inputSpecs)
+        self._checkColorSize()
+
+    def _checkColorSize(self):
+        # colors of a different size aren't supported
+        self._ignoreColor = self._inputSpecKnown(1) and self._inputSpecs[1].shape[1] != self.num_pixels
+
     @staticmethod
     def getParameterDefinition():
         definition = {
@@ -311,7 +451,7 @@ class VUMeterPeak(Effect):
             return
         buffer = self._inputBuffer[0]
         if buffer is None:
-            self._outputBuffer[0] = None
+            # no new audio, hold the meter
             return
         color = self._inputBuffer[1]
         if color is None:
@@ -320,8 +460,8 @@ class VUMeterPeak(Effect):
             except Exception:
                 self.__initstate__()
                 color = self._default_color
-        if self.num_pixels != np.size(color, axis=1):
-            self.__initstate__()
+        elif self._ignoreColor or (not self._inputSpecKnown(1) and color.shape[1] != self.num_pixels):
+            # colors of a different size aren't supported
             color = self._default_color
 
         y = self._inputBuffer[0]
@@ -351,6 +491,8 @@ class MovingLight(Effect):
     Inputs:
     - 0: Audio
     - 1: Color
+    - 2: Envelope (optional), e.g. the peak of a band from BandFilterBank.
+         If connected, it is used instead of bandpass filtering the audio.
     """
 
     def __init__(self, num_pixels, fs, speed=100.0, dim_time=2.5, lowcut_hz=50.0, highcut_hz=300.0, peak_scale = 4.0, peak_filter = 2.6, highlight=0.6):
@@ -368,17 +510,23 @@ class MovingLight(Effect):
     def __initstate__(self):
         # state
         self._pixel_state = np.zeros(self.num_pixels) * np.array([[0.0],[0.0],[0.0]])
-        self._filter_b, self._filter_a, self._filter_zi = dsp.design_filter(self.lowcut_hz, self.highcut_hz, self.fs, 3)
+        self._filter = dsp.SOSFilter(*dsp.design_filter(self.lowcut_hz, self.highcut_hz, self.fs, 3, output='sos'))
         self._last_t = 0.0
         self._last_move_t = 0.0
         super(MovingLight, self).__initstate__()
 
     def numInputChannels(self):
-        return 2
+        return 3
 
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        self._checkPixelSpec(inputSpecs, 1)
+        self._checkVectorSpec(inputSpecs, 2, 'an envelope')
+        return [BufferSpec((3, self.num_pixels))]
+
     @staticmethod
     def getParameterDefinition():
         definition = {
@@ -411,13 +559,18 @@ class MovingLight(Effect):
             return
         buffer = self._inputBuffer[0]
         color = self._inputBuffer[1]
+        envelope = self._inputBuffer[2]
         if color is None:
             # default color: all white
             color = np.ones(self.num_pixels) * np.array([[255.0],[255.0],[255.0]])
-        if buffer is not None:
-            audio = self._inputBuffer[0]
-            # apply bandpass to audio
-            y, self._filter_zi = lfilter(b=self._filter_b, a=self._filter_a, x=np.array(audio), zi=self._filter_zi)
+        if buffer is not None or envelope is not None:
+            if envelope is not None:
+                peak = float(envelope[0])
+            else:
+                audio = self._inputBuffer[0]
+                # apply bandpass to audio
+                y = self._filter.process(audio)
+                peak = np.max(y) * 1.0
             # move in speed
             dt_move = self._t - self._last_move_t
             if dt_move * self.speed > 1:
@@ -435,7 +588,6 @@ class MovingLight(Effect):
             self._pixel_state = gaussian_filter1d(self._pixel_state, sigma=0.5, axis=1)
             self._pixel_state = gaussian_filter1d(self._pixel_state, sigma=0.5, axis=1)
             # new color at origin
-            peak = np.max(y) * 1.0
             try:
                 peak = peak ** self.peak_filter
             except Exception:
@@ -447,3 +599,197 @@ class MovingLight(Effect):
             self._pixel_state[2][0] = b * peak + self.highlight * peak * 255.0
             self._pixel_state = np.nan_to_num(self._pixel_state).clip(0.0, 255.0)
             self._outputBuffer[0] = self._pixel_state
+
+
+class BandFilterBank(Effect):
+    """
+    BandFilterBank filters the audio through up to 8 bandpass filters and provides
+    the peak and rms of every band, e.g. as envelope for several MovingLight effects.
+
+    Inputs:
+    - 0: Audio
+
+    Outputs:
+    - 2 * i: Peak of band i
+    - 2 * i + 1: RMS of band i
+    """
+
+    def __init__(self, fs, num_bands=4,
+                 lowcut0=50.0, highcut0=300.0, lowcut1=300.0, highcut1=1000.0,
+                 lowcut2=1000.0, highcut2=3000.0, lowcut3=3000.0, highcut3=8000.0,
+                 lowcut4=50.0, highcut4=100.0, lowcut5=100.0, highcut5=200.0,
+                 lowcut6=200.0, highcut6=400.0, lowcut7=400.0, highcut7=800.0):
+        self.fs = fs
+        self.num_bands = num_bands
+        self.lowcut0 = lowcut0
+        self.highcut0 = highcut0
+        self.lowcut1 = lowcut1
+        self.highcut1 = highcut1
+        self.lowcut2 = lowcut2
+        self.highcut2 = highcut2
+        self.lowcut3 = lowcut3
+        self.highcut3 = highcut3
+        self.lowcut4 = lowcut4
+        self.highcut4 = highcut4
+        self.lowcut5 = lowcut5
+        self.highcut5 = highcut5
+        self.lowcut6 = lowcut6
+        self.highcut6 = highcut6
+        self.lowcut7 = lowcut7
+        self.highcut7 = highcut7
+        self.__initstate__()
+
+    def __initstate__(self):
+        # state
+        bands = [(self.lowcut0, self.highcut0), (self.lowcut1, self.highcut1),
+                 (self.lowcut2, self.highcut2), (self.lowcut3, self.highcut3),
+                 (self.lowcut4, self.highcut4), (self.lowcut5, self.highcut5),
+                 (self.lowcut6, self.highcut6), (self.lowcut7, self.highcut7)]
+        self._envelopes = dsp.BandEnvelopes(bands[0:self.num_bands], self.fs, 3)
+        super(BandFilterBank, self).__initstate__()
+
+    def numInputChannels(self):
+        return 1
+
+    def numOutputChannels(self):
+        return 2 * self.num_bands
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'audio samples')
+        return [BufferSpec((1,)) for i in range(0, 2 * self.num_bands)]
+
+    @staticmethod
+    def getParameterDefinition():
+        definition = {
+            "parameters": {
+                # default, min, max, stepsize
+                "fs": [48000, 44100, 96000, 100],
+                "num_bands": [4, 1, 8, 1],
+                "lowcut0": [50.0, 1.0, 8000.0, 1.0],
+                "highcut0": [300.0, 1.0, 8000.0, 1.0],
+                "lowcut1": [300.0, 1.0, 8000.0, 1.0],
+                "highcut1": [1000.0, 1.0, 8000.0, 1.0],
+                "lowcut2": [1000.0, 1.0, 8000.0, 1.0],
+                "highcut2": [3000.0, 1.0, 8000.0, 1.0],
+                "lowcut3": [3000.0, 1.0, 8000.0, 1.0],
+                "highcut3": [8000.0, 1.0, 8000.0, 1.0],
+                "lowcut4": [50.0, 1.0, 8000.0, 1.0],
+                "highcut4": [100.0, 1.0, 8000.0, 1.0],
+                "lowcut5": [100.0, 1.0, 8000.0, 1.0],
+                "highcut5": [200.0, 1.0, 8000.0, 1.0],
+                "lowcut6": [200.0, 1.0, 8000.0, 1.0],
+                "highcut6": [400.0, 1.0, 8000.0, 1.0],
+                "lowcut7": [400.0, 1.0, 8000.0, 1.0],
+                "highcut7": [800.0, 1.0, 8000.0, 1.0],
+            }
+        }
+        return definition
+
+    def getParameter(self):
+        definition = self.getParameterDefinition()
+        del definition['parameters']['fs'] # disable edit
+        del definition['parameters']['num_bands'] # not editable at runtime
+        definition['parameters']['lowcut0'][0] = self.lowcut0
+        definition['parameters']['highcut0'][0] = self.highcut0
+        definition['parameters']['lowcut1'][0] = self.lowcut1
+        definition['parameters']['highcut1'][0] = self.highcut1
+        definition['parameters']['lowcut2'][0] = self.lowcut2
+        definition['parameters']['highcut2'][0] = self.highcut2
+        definition['parameters']['lowcut3'][0] = self.lowcut3
+        definition['parameters']['highcut3'][0] = self.highcut3
+        definition['parameters']['lowcut4'][0] = self.lowcut4
+        definition['parameters']['highcut4'][0] = self.highcut4
+        definition['parameters']['lowcut5'][0] = self.lowcut5
+        definition['parameters']['highcut5'][0] = self.highcut5
+        definition['parameters']['lowcut6'][0] = self.lowcut6
+        definition['parameters']['highcut6'][0] = self.highcut6
+        definition['parameters']['lowcut7'][0] = self.lowcut7
+        definition['parameters']['highcut7'][0] = self.highcut7
+        return definition
+
+    def process(self):
+        if self._inputBuffer is None or self._outputBuffer is None:
+            return
+        audio = self._inputBuffer[0]
+        if audio is None:
+            for i in range(0, 2 * self.num_bands):
+                self._outputBuffer[i] = None
+            return
+        peak, rms = self._envelopes.process(audio)
+        for i in range(0, self.num_bands):
+            self._outputBuffer[2 * i] = peak[i:i + 1]
+            self._outputBuffer[2 * i + 1] = rms[i:i + 1]
+
+
+class BeatDetector(Effect):
+    """
+    BeatDetector detects onsets in the power spectrum of SpectrumAnalyzer and follows the beat.
+
+    Inputs:
+    - 0: Power spectrum
+
+    Outputs:
+    - 0: Onset strength (spectral flux)
+    - 1: Beat, 1.0 on beats, 0.0 otherwise
+    - 2: Tempo in bpm, 0.0 until enough audio has been analyzed
+    """
+
+    def __init__(self, threshold=1.5, min_bpm=60.0, max_bpm=180.0):
+        self.threshold = threshold
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.__initstate__()
+
+    def __initstate__(self):
+        # state
+        self._detector = None
+        self._last_t = 0.0
+        super(BeatDetector, self).__initstate__()
+
+    def numInputChannels(self):
+        return 1
+
+    def numOutputChannels(self):
+        return 3
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkVectorSpec(inputSpecs, 0, 'a spectrum')
+        return [BufferSpec((1,)) for i in range(0, 3)]
+
+    @staticmethod
+    def getParameterDefinition():
+        definition = {
+            "parameters": {
+                # default, min, max, stepsize
+                "threshold": [1.5, 0.0, 5.0, 0.1],
+                "min_bpm": [60.0, 30.0, 120.0, 1.0],
+                "max_bpm": [180.0, 90.0, 240.0, 1.0],
+            }
+        }
+        return definition
+
+    def getParameter(self):
+        definition = self.getParameterDefinition()
+        definition['parameters']['threshold'][0] = self.threshold
+        definition['parameters']['min_bpm'][0] = self.min_bpm
+        definition['parameters']['max_bpm'][0] = self.max_bpm
+        return definition
+
+    def process(self):
+        if self._inputBuffer is None or self._outputBuffer is None:
+            return
+        spectrum = self._inputBuffer[0]
+        dt = self._t - self._last_t
+        if spectrum is None or dt <= 0:
+            # no new spectrum, a beat is only given once
+            for i in range(0, 3):
+                self._outputBuffer[i] = None
+            return
+        self._last_t = self._t
+        if self._detector is None:
+            # one spectrum per frame, the detector follows changes of the frame rate
+            self._detector = dsp.OnsetDetector(1.0 / dt, self.threshold, self.min_bpm, self.max_bpm)
+        flux, onset, beat = self._detector.process(spectrum, dt)
+        self._outputBuffer[0] = np.array([flux])
+        self._outputBuffer[1] = np.array([1.0 if beat else 0.0])
+        self._outputBuffer[2] = np.array([self._detector.bpm])
@@ -10,12 +10,17 @@ import audioled.dsp as dsp
 import audioled.filtergraph as filtergraph
 import math
 import matplotlib as mpl
-from audioled.effect import Effect
+from audioled.effect import Effect, BufferSpec
 
 blend_modes = ['lightenOnly', 'darkenOnly', 'addition', 'multiply', 'screen','overlay','softLight']
 blend_mode_default = 'lightenOnly'
 
-def blend(pixel_a, pixel_b, blend_mode):
+def blend(pixel_a, pixel_b, blend_mode, out=None):
+    """Blends two pixel arrays
+
+    The result is written into `out` if given, otherwise into a new array.
+    The shape of `out` has to match the broadcasted shape of pixel_a and pixel_b.
+    """
     if pixel_a is None and pixel_b is None:
         return None
     elif not pixel_a is None and pixel_b is None:
@@ -23,21 +28,27 @@ def blend(pixel_a, pixel_b, blend_mode):
     elif pixel_a is None and not pixel_b is None:
         return pixel_b
     
+    if out is None:
+        out = np.empty(np.broadcast(pixel_a, pixel_b).shape)
 
     if blend_mode == 'lightenOnly':
-        return np.maximum(pixel_a, pixel_b)
+        return np.maximum(pixel_a, pixel_b, out=out)
     elif blend_mode == 'darkenOnly':
-        return np.minimum(pixel_a, pixel_b)
+        return np.minimum(pixel_a, pixel_b, out=out)
     elif blend_mode == 'addition':
-        return pixel_a + pixel_b
+        return np.add(pixel_a, pixel_b, out=out)
     elif blend_mode == 'multiply':
-        pA = pixel_a / 255.0
-        pB = pixel_b / 255.0
-        return 255.0 * pA * pB
+        # 255 * a/255 * b/255
+        out = np.multiply(pixel_a, pixel_b, out=out)
+        out *= 1. / 255.0
+        return out
     elif blend_mode == 'screen':
-        pA = pixel_a / 255.0
-        pB = pixel_b / 255.0
-        return 255.0 * (1 - (1 - pA) * (1 - pB))
+        # 255 * (1 - (1 - a/255) * (1 - b/255)) = a + b - a*b/255
+        out = np.multiply(pixel_a, pixel_b, out=out)
+        out *= -1. / 255.0
+        out += pixel_a
+        out += pixel_b
+        return out
     elif blend_mode == 'overlay':
         pA = pixel_a / 255.0
         pB = pixel_b / 255.0
@@ -46,15 +57,16 @@ def blend(pixel_a, pixel_b, blend_mode):
         blended = np.zeros(np.shape(pA))
         blended[~mask] = (2*pA*pB)[~mask]
         blended[mask] = (1-2*(1-pA)*(1-pB))[mask]
-        return 255.0 * blended
+        return np.multiply(blended, 255.0, out=out)
     elif blend_mode == 'softLight':
         # pegtop
         pA = pixel_a / 255.0
         pB = pixel_b / 255.0
         blended = (1-2*pB) * pA * pA + 2*pB*pA
-        return 255.0 * blended
+        return np.multiply(blended, 255.0, out=out)
     
-    return pixel_a
+    out[...] = pixel_a
+    return out
 
 
 
@@ -81,6 +93,12 @@ class StaticRGBColor(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((3, self.num_pixels))]
+
+    def isTimeInvariant(self):
+        return True
+
 
     @staticmethod
     def getParameterDefinition():
@@ -140,6 +158,13 @@ class ColorWheel(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((3, self.num_pixels))]
+
+    def isTimeInvariant(self):
+        # color doesn't move without cycle and wiggle
+        return self.cycle_time == 0 and (self.wiggle_time == 0 or self.wiggle_amplitude == 0)
+
     @staticmethod
     def getParameterDefinition():
         definition = {
@@ -210,6 +235,9 @@ class ColorWheel2_gen(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((3, self.num_pixels))]
+
     def get_color(self, t, pixel):
         L = 0.5
         S = 1.0
@@ -252,6 +280,9 @@ class ColorDimEffect(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((3, self.num_pixels))]
+
     async def update(self, dt):
         await super(ColorDimEffect, self).update(dt)
         self._color = self.get_color_array(self._t, self.num_pixels)
@@ -282,6 +313,17 @@ class InterpolateRGB(Effect):
 
     def numOutputChannels(self):
         return 1
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0, self.num_pixels)
+        self._checkPixelSpec(inputSpecs, 1, self.num_pixels)
+        if inputSpecs[0] is None or inputSpecs[1] is None:
+            # a single input is passed through
+            return [inputSpecs[0] if inputSpecs[1] is None else inputSpecs[1]]
+        return [BufferSpec((3, self.num_pixels))]
+
+    def isTimeInvariant(self):
+        return True
     
     def process(self):
         if self._inputBuffer is not None and self._outputBuffer is not None:
@@ -305,6 +347,14 @@ class InterpolateHSV(Effect):
 
     def numOutputChannels(self):
         return 1
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        self._checkPixelSpec(inputSpecs, 1)
+        return [BufferSpec((3, self.num_pixels))]
+
+    def isTimeInvariant(self):
+        return True
     
     def process(self):
         if self._inputBuffer is not None and self._outputBuffer is not None:
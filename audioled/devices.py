@@ -2,9 +2,12 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import struct
 import time
+from timeit import default_timer as timer
 import numpy as np
 from audioled.effect import Effect
+from audioled import filtergraph
 
 _GAMMA_TABLE = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1,
                 1, 1, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5,
@@ -325,6 +328,63 @@ class DotStar(LEDController):
         self.led_data[0:,1:4] = (pixels*self.getBrightness())[bgr].T.clip(0,255)
         self._strip.show()
 
+class FrameRecorder(LEDController):
+    """Records frames to a binary file instead of showing them
+
+    The file starts with a header of FRAME_MAGIC, the number of pixels (uint32)
+    and the frame rate (float32), followed by the frames as uint8 RGB triplets per pixel.
+    The header is written with the first frame, all frames need to have the same size.
+    Call tick() once per graph frame to keep one frame per tick in the file: ticks
+    without a new frame repeat the last frame, ticks before the first frame are written as black.
+    """
+    FRAME_MAGIC = b'ALEDFRM1'
+    HEADER_FORMAT = '<8sIf'
+
+    def __init__(self, path, fps, brightness=1.0):
+        super(FrameRecorder, self).__init__(brightness)
+        self.path = path
+        self.fps = fps
+        self.frameCount = 0
+        self._file = None
+        self._num_pixels = None
+        self._frame = None
+        self._shown = False
+        self._missedFrames = 0
+
+    def show(self, pixels):
+        if self._file is None:
+            self._num_pixels = pixels.shape[1]
+            self._frame = np.zeros((self._num_pixels, 3), dtype=np.uint8)
+            self._file = open(self.path, 'wb')
+            self._file.write(struct.pack(self.HEADER_FORMAT, self.FRAME_MAGIC, self._num_pixels, self.fps))
+            for i in range(0, self._missedFrames):
+                self._writeFrame()
+        if pixels.shape[1] != self._num_pixels:
+            raise ValueError("Expected {} pixels, got {}".format(self._num_pixels, pixels.shape[1]))
+        # truncate like the hardware devices
+        self._frame[...] = np.clip(pixels.T * self.getBrightness(), 0, 255)
+        self._writeFrame()
+        self._shown = True
+
+    def tick(self):
+        if self._shown:
+            self._shown = False
+        elif self._file is None:
+            # the number of pixels isn't known yet
+            self._missedFrames += 1
+        else:
+            self._writeFrame()
+
+    def _writeFrame(self):
+        self._file.write(self._frame.tobytes())
+        self.frameCount += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 class LEDOutput(Effect):
     overrideDevice = None
 
@@ -358,15 +418,32 @@ class LEDOutput(Effect):
         definition['parameters']['brightness'][0] = self.controller.getBrightness()
         return definition
     
+    def __initstate__(self):
+        try:
+            self._showTiming
+        except AttributeError:
+            self._showTiming = filtergraph.Timing()
+        super(LEDOutput, self).__initstate__()
+
+    def getShowTiming(self):
+        """Returns the Timing of sending pixels to the controller"""
+        return self._showTiming
+
     def numInputChannels(self):
         return 1
     def numOutputChannels(self):
         return 0
-        
+
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        return []
+
     def process(self):
         if self._inputBuffer != None:
             if self._inputBuffer[0] is not None:
+                start = timer()
                 self.controller.show(self._inputBuffer[0])
+                self._showTiming.update(timer() - start)
 
 # # Execute this file to run a LED strand test
 # # If everything is working, you should see a red, green, and blue pixel scroll
@@ -3,26 +3,90 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import absolute_import
 from scipy.signal import butter
+from scipy.signal import firwin
 from scipy.signal import lfilter_zi
+from scipy.signal import sosfilt
+from scipy.signal import sosfilt_zi
+from scipy.sparse import csr_matrix
+import scipy.fft
 import itertools
 import numpy as np
-import math
+from numpy.lib.stride_tricks import as_strided
 
 
+class RollingWindow(object):
+    """Ring buffer holding the last `length` samples of a signal
+
+    Writing a chunk only touches the samples of the chunk, independent of the window length.
+    """
+
+    def __init__(self, length):
+        self._data = np.zeros(length)
+        # index of the oldest sample
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def write(self, chunk):
+        L = len(self._data)
+        chunk = chunk[-L:]
+        end = self._pos + len(chunk)
+        if end <= L:
+            self._data[self._pos:end] = chunk
+        else:
+            split = L - self._pos
+            self._data[self._pos:] = chunk[:split]
+            self._data[:end - L] = chunk[split:]
+        self._pos = end % L
+
+    def read(self, out=None, window=None):
+        """Copies the samples from oldest to newest to out, multiplied by window if given"""
+        L = len(self._data)
+        if out is None:
+            out = np.empty(L)
+        head = L - self._pos
+        if window is None:
+            out[:head] = self._data[self._pos:]
+            out[head:L] = self._data[:self._pos]
+        else:
+            np.multiply(self._data[self._pos:], window[:head], out=out[:head])
+            np.multiply(self._data[:self._pos], window[head:], out=out[head:L])
+        return out
+
 
 def rollwin(signal, n_overlaps):
     """
     Generates a rolling window of samples
+
+    The same array is yielded for every chunk.
     """
     frame = next(signal)
     N = len(frame)
-    window = np.zeros(N * n_overlaps)
-    window[-N:] = frame # last N points
+    window = RollingWindow(N * n_overlaps)
+    window.write(frame) # last N points
+    out = np.empty(len(window))
     for data in signal:
-        S = len(data)
-        window[:-S] = window[S:]
-        window[-S:] = data[:S]
-        yield window
+        window.write(data)
+        yield window.read(out)
+
+
+def hann_rollwin(signal, n_overlaps):
+    """
+    Generates a Hann windowed rolling window of samples, padded with zeros to a power of two
+
+    The samples are written with the Hann window applied directly into the padded buffer,
+    so the cost per chunk is a single pass over the window regardless of n_overlaps.
+    The same array is yielded for every chunk.
+    """
+    frame = next(signal)
+    window = RollingWindow(len(frame) * n_overlaps)
+    hanning_window = np.hanning(len(window))
+    out = np.zeros(int(2**np.ceil(np.log2(len(window)))))
+    for data in itertools.chain([frame], signal):
+        window.write(data)
+        window.read(out, hanning_window)
+        yield out
 
 
 def normalize_scale(signal, past_n):
@@ -101,6 +165,67 @@ def downsample(signal, fs, fmax):
         return ds_signal, ds_fs
 
 
+class Decimator(object):
+    """Stateful polyphase FIR decimator
+
+    Low-pass filters the signal below the new Nyquist frequency and keeps every q-th sample.
+    Only the kept samples are computed, and the filter history and sample phase are carried
+    across chunks, so chunks can have any length.
+    """
+
+    def __init__(self, q, numtaps=None):
+        if numtaps is None:
+            numtaps = 20 * q + 1
+        self.q = q
+        # reversed taps, so the filter is a dot product with the last numtaps samples
+        self._taps = firwin(numtaps, 1.0 / q)[::-1].copy()
+        self._buffer = np.zeros(numtaps - 1)
+        # index of the next kept sample in the next chunk
+        self._offset = 0
+
+    def process(self, chunk):
+        L = len(self._taps) - 1
+        S = len(chunk)
+        if len(self._buffer) != L + S:
+            buffer = np.zeros(L + S)
+            buffer[:L] = self._buffer[-L:] if L > 0 else []
+            self._buffer = buffer
+        else:
+            # keep the last L samples as filter history
+            self._buffer[:L] = self._buffer[S:]
+        self._buffer[L:] = chunk
+        n_out = max(0, -(-(S - self._offset) // self.q))
+        # windows of numtaps samples ending at every kept sample
+        step = self._buffer.strides[0]
+        windows = as_strided(self._buffer[self._offset:], shape=(n_out, L + 1), strides=(self.q * step, step), writeable=False)
+        out = np.dot(windows, self._taps)
+        self._offset = self._offset + n_out * self.q - S
+        return out
+
+
+def decimate(signal, fs, fmax, numtaps=None):
+    """Decimates signal by integer factor if fs > 2 * fmax
+
+    Like downsample, but with an anti-aliasing FIR filter, see Decimator.
+
+    Returns
+    -------
+    ds_signal : generator
+        Generator that yields the decimated chunks, or the original signal generator
+        if decimating is not possible
+    ds_fs : int
+        The decimated sampling rate
+    """
+    if fs < 2 * fmax:
+        raise ValueError('Sampling frequency fs must be at least 2 * fmax')
+    n = int(fs / (2 * fmax))
+    if n == 1:
+        # Decimating is not possible
+        return signal, fs
+    decimator = Decimator(n, numtaps)
+    return (decimator.process(chunk) for chunk in signal), int(fs // n)
+
+
 def pad_zeros(signal):
     """Pad chunks with zeros until chunk length is a power of two
 
@@ -154,68 +279,295 @@ def memoize(function):
     return wrapper
 
 
-@memoize
-def filter_bank(n_filters, n_fft, fs, fmin_hz, fmax_hz, scale):
-    """Returns an overlapping triangular filterbank"""
+def _filter_bank_hz(n_filters, fmin_hz, fmax_hz, scale):
+    """Returns the n_filters + 2 corner frequencies of the filter bank in Hz"""
     if scale == 'mel':
         fmin_mel = 2595. * np.log10(1 + fmin_hz / 700.)
         fmax_mel = 2595. * np.log10(1 + fmax_hz / 700.)
         f_mel = np.linspace(fmin_mel, fmax_mel, n_filters + 2)
-        f_hz = 700. * (np.exp(f_mel / 1127.) - 1.)
+        return 700. * (np.exp(f_mel / 1127.) - 1.)
     elif scale == 'bark':
         fmin_bark = 6.0 * np.arcsinh(fmin_hz / 600.0)
         fmax_bark = 6.0 * np.arcsinh(fmax_hz / 600.0)
         f_bark = np.linspace(fmin_bark, fmax_bark, n_filters + 2)
-        f_hz = 600.0 * np.sinh(f_bark / 6.0)
+        return 600.0 * np.sinh(f_bark / 6.0)
+    raise ValueError("Unknown scale {}".format(scale))
+
+
+@memoize
+def filter_bank(n_filters, n_fft, fs, fmin_hz, fmax_hz, scale):
+    """Returns an overlapping triangular filterbank"""
+    f_hz = _filter_bank_hz(n_filters, fmin_hz, fmax_hz, scale)
     # Convert from Hz points to FFT bin number
     bins = np.floor((n_fft + 1.) * f_hz / fs)
-    # Construct the filter bank
-    filters = np.zeros((n_filters, n_fft // 2 + 1))
-    for m in range(1, n_filters + 1):
-        f_m_minus = int(bins[m - 1])   # left
-        f_m = int(bins[m])             # center
-        f_m_plus = int(bins[m + 1])    # right
-        for k in range(f_m_minus, f_m):
-            filters[m - 1, k] = (k - bins[m - 1]) / (bins[m] - bins[m - 1])
-        for k in range(f_m, f_m_plus):
-            filters[m - 1, k] = (bins[m + 1] - k) / (bins[m + 1] - bins[m])
+    left = bins[:-2, np.newaxis]
+    center = bins[1:-1, np.newaxis]
+    right = bins[2:, np.newaxis]
+    k = np.arange(0, n_fft // 2 + 1)
+    # Construct the filter bank, rising edges from left to center, falling edges from center to right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rising = (k - left) / (center - left)
+        falling = (right - k) / (right - center)
+    filters = np.where((k >= left) & (k < center), rising, 0.0)
+    filters = np.where((k >= center) & (k < right), falling, filters)
     return filters, f_hz[1:-1]
 
 
-def warped_psd(y, bins, fs, frange, scale):
-    """Returns the power spectrum mapped to a perceptual scale"""
+@memoize
+def _sparse_filter_bank(n_filters, n_fft, fs, fmin_hz, fmax_hz, scale):
+    filters, f = filter_bank(n_filters, n_fft, fs, fmin_hz, fmax_hz, scale)
+    return csr_matrix(filters)
+
+
+def sparse_filter_bank(n_filters, n_fft, fs, fmin_hz, fmax_hz, scale):
+    """Returns the triangular filterbank as sparse matrix of shape (n_filters, n_fft // 2 + 1)
+
+    Every filter only covers a few FFT bins, so applying the sparse matrix
+    takes a fraction of the multiplications of the dense filter bank.
+    Filter banks are cached, the arguments are normalized so equal values share a cache entry.
+    """
+    return _sparse_filter_bank(int(n_filters), int(n_fft), float(fs), float(fmin_hz), float(fmax_hz), str(scale))
+
+
+def power_spectrum(y):
+    """Returns the power spectrum of the real signal y"""
     N = len(y)
     # Transform to frequency domain
-    pow_spectrum = np.absolute(np.fft.rfft(y))**2 * (2 / N)
+    return np.absolute(np.fft.rfft(y))**2 * (2 / N)
+
+
+class PowerSpectrum(object):
+    """Power spectrum of frames zero padded to n_fft samples, computed with reused buffers
+
+    Frames are copied into a preallocated zero padded input buffer, which scipy.fft
+    may overwrite. The power spectrum is written to `output`, which is reused for every frame.
+    scipy.fft has no output argument, so the complex spectrum is still a new array.
+    workers is the number of threads scipy.fft may use, None for a single thread.
+    """
+
+    def __init__(self, n_fft, workers=None):
+        self.n_fft = n_fft
+        self.workers = workers
+        self.output = np.empty(n_fft // 2 + 1)
+        self._input = np.zeros(n_fft)
+
+    def compute(self, y):
+        """Returns the power spectrum of y, see power_spectrum"""
+        n = len(y)
+        self._input[:n] = y
+        # the previous transform may have overwritten the padding
+        self._input[n:] = 0.0
+        spectrum = scipy.fft.rfft(self._input, workers=self.workers, overwrite_x=True)
+        np.absolute(spectrum, out=self.output)
+        np.multiply(self.output, self.output, out=self.output)
+        np.multiply(self.output, 2 / self.n_fft, out=self.output)
+        return self.output
+
+
+def warp_psd(pow_spectrum, n_fft, bins, fs, frange, scale):
+    """Maps the power spectrum of a n_fft point FFT to a perceptual scale"""
     # Construct triangular filter bank
-    output, f = filter_bank(bins, N, fs, frange[0], frange[1], scale)
+    bank = sparse_filter_bank(bins, n_fft, fs, frange[0], frange[1], scale)
     # Apply filter bank to power spectrum
-    output = np.dot(pow_spectrum, output.T)
-    return output
+    return bank.dot(pow_spectrum)
+
+
+def warped_psd(y, bins, fs, frange, scale):
+    """Returns the power spectrum mapped to a perceptual scale"""
+    return warp_psd(power_spectrum(y), len(y), bins, fs, frange, scale)
 
 
 def preprocess(audio, fs, fmax, n_overlaps):
-    # Downsample if we don't need high frequencies
-    audio, fs = downsample(audio, fs=fs, fmax=fmax)
-    # Create rolling window of last audio chunks
-    audio = rollwin(audio, n_overlaps)
-    # Construct hanning window to smooth audio at the edges
-    hanning_window = np.hanning(len(next(audio)))
-    # Apply hanning window
-    audio = (x * hanning_window for x in audio)
+    # Decimate if we don't need high frequencies
+    audio, fs = decimate(audio, fs=fs, fmax=fmax)
+    # Rolling window of last audio chunks, smoothed at the edges by a hanning window and zero padded
+    audio = hann_rollwin(audio, n_overlaps)
     # Don't know what this should do but breaks processing if no audio input present... 
     #audio = (x for x in audio if np.sqrt(np.mean(np.square(x))) > 1e-5)
-    audio = pad_zeros(audio)
     return audio, fs
 
-def rms(normalized_sample_points):
-    N = len(normalized_sample_points)
-    sum_squares = sum(s**2  for s in normalized_sample_points)
-    return math.sqrt(sum_squares / (N / 2))
+def rms(normalized_sample_points, axis=None):
+    """Returns the rms of the samples normalized to N / 2 samples
+
+    If axis is given, the rms is computed along this axis, e.g. axis=0 for every channel
+    of a (frames, channels) buffer.
+    """
+    samples = np.asarray(normalized_sample_points)
+    N = samples.size if axis is None else samples.shape[axis]
+    sum_squares = np.sum(np.square(samples, dtype=np.float64), axis=axis)
+    return np.sqrt(sum_squares / (N / 2))
+
+def design_filter(lowcut, highcut, fs, order=3, output='ba'):
+    """Designs a butterworth bandpass filter
 
-def design_filter(lowcut, highcut, fs, order=3):
+    Returns b, a and the initial state for lfilter if output is 'ba',
+    or the second-order sections and the initial state for sosfilt if output is 'sos'.
+    Second-order sections stay numerically stable at low cutoff frequencies.
+    """
     nyq = 0.5*fs
     low = lowcut/nyq
     high = highcut/nyq
+    if output == 'sos':
+        sos = butter(order, [low, high], btype='band', output='sos')
+        return sos, sosfilt_zi(sos)
     b,a = butter(order, [low,high], btype='band')
     return b,a,lfilter_zi(b, a)
+
+
+class SOSFilter(object):
+    """IIR filter in second-order sections with the filter state carried across chunks"""
+
+    def __init__(self, sos, zi):
+        self.sos = sos
+        self.zi = zi
+
+    def process(self, x):
+        y, self.zi = sosfilt(self.sos, x, zi=self.zi)
+        return y
+
+
+class BandEnvelopes(object):
+    """Peak and rms of a signal in several frequency bands
+
+    Every band has its own butterworth bandpass in second-order sections, the filter
+    states are carried across chunks. The peak is the largest filtered sample of the chunk,
+    the same as the peak MovingLight computes from the audio.
+    The bands are filtered one after the other, sosfilt applies the same sections to every
+    row of an array, so the bands can't be filtered in a single call.
+    """
+
+    def __init__(self, bands, fs, order=3):
+        self.bands = bands
+        self.fs = fs
+        self.order = order
+        self._filters = [SOSFilter(*design_filter(lowcut, highcut, fs, order, output='sos')) for lowcut, highcut in bands]
+
+    def process(self, chunk):
+        """Returns the peak and rms of every band for the given chunk"""
+        peak = np.empty(len(self._filters))
+        band_rms = np.empty(len(self._filters))
+        for i, band_filter in enumerate(self._filters):
+            y = band_filter.process(chunk)
+            peak[i] = np.max(y)
+            band_rms[i] = rms(y)
+        return peak, band_rms
+
+
+class OnsetDetector(object):
+    """Streaming onset, beat and tempo detection on consecutive power spectra
+
+    Onsets are frames where the spectral flux, the mean increase of the log compressed
+    power spectrum, exceeds the mean plus `threshold` standard deviations of the recent flux
+    and twice its mean, so stationary noise doesn't cause onsets.
+    The tempo is the lag with the largest autocorrelation of the flux history, weighted towards
+    120 bpm to avoid octave errors. Beats follow the tempo and are aligned to onsets close to them.
+
+    frame_rate is the initial number of spectra per second. If process() is given the time
+    between frames, the frame rate follows a running average of it.
+    """
+
+    def __init__(self, frame_rate, threshold=1.5, min_bpm=60.0, max_bpm=180.0, history_time=6.0,
+                 threshold_time=0.5, min_onset_interval=0.1, compression=1000.0):
+        self.threshold = threshold
+        self.compression = compression
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.history_time = history_time
+        self.threshold_time = threshold_time
+        self.min_onset_interval = min_onset_interval
+        self._history = None
+        self._frame_time = 1.0 / frame_rate
+        self._set_frame_rate(frame_rate)
+        self._num_frames = 0
+        self._last_onset = -np.inf
+        self._log_spectrum = None
+        self._last_log_spectrum = None
+        self._phase = 0.0
+        self._last_beat = -np.inf
+        self.bpm = 0.0
+
+    def _set_frame_rate(self, frame_rate):
+        """Converts the time constants to frames, keeping the most recent flux history"""
+        self.frame_rate = frame_rate
+        self._min_onset_frames = self.min_onset_interval * frame_rate
+        self._threshold_frames = max(2, int(self.threshold_time * frame_rate))
+        length = max(2 * self._threshold_frames, int(self.history_time * frame_rate))
+        if self._history is None or len(self._history) != length:
+            history = RollingWindow(length)
+            if self._history is not None:
+                history.write(self._history.read(self._flux))
+            self._history = history
+            self._flux = np.empty(length)
+            # autocorrelation of the flux history
+            self._n_fft = int(2**np.ceil(np.log2(2 * length)))
+        self._min_lag = max(1, int(np.floor(60.0 * frame_rate / self.max_bpm)))
+        self._max_lag = min(len(self._history) // 2, int(np.ceil(60.0 * frame_rate / self.min_bpm)))
+        lags = np.arange(self._min_lag, self._max_lag + 1)
+        self._lag_weights = np.exp(-0.5 * np.log2(60.0 * frame_rate / lags / 120.0)**2)
+
+    def _spectral_flux(self, pow_spectrum):
+        if self._log_spectrum is None or len(self._log_spectrum) != len(pow_spectrum):
+            self._log_spectrum = np.empty(len(pow_spectrum))
+            self._last_log_spectrum = None
+        np.multiply(pow_spectrum, self.compression, out=self._log_spectrum)
+        np.log1p(self._log_spectrum, out=self._log_spectrum)
+        if self._last_log_spectrum is None:
+            self._last_log_spectrum = self._log_spectrum.copy()
+            return 0.0
+        # only increases of energy count, written to the buffer of the previous spectrum
+        np.subtract(self._log_spectrum, self._last_log_spectrum, out=self._last_log_spectrum)
+        np.maximum(self._last_log_spectrum, 0.0, out=self._last_log_spectrum)
+        flux = np.mean(self._last_log_spectrum)
+        self._log_spectrum, self._last_log_spectrum = self._last_log_spectrum, self._log_spectrum
+        return flux
+
+    def _estimate_tempo(self, flux):
+        flux = flux - np.mean(flux)
+        spectrum = np.fft.rfft(flux, n=self._n_fft)
+        autocorrelation = np.fft.irfft(spectrum.real**2 + spectrum.imag**2, n=self._n_fft)
+        if autocorrelation[0] <= 0:
+            return 0.0
+        lag = self._min_lag + np.argmax(autocorrelation[self._min_lag:self._max_lag + 1] * self._lag_weights)
+        return 60.0 * self.frame_rate / lag
+
+    def process(self, pow_spectrum, dt=None):
+        """Returns the onset strength and whether the frame is an onset and a beat
+
+        dt is the time since the previous frame, without it frames are 1 / frame_rate apart.
+        The current tempo estimate is available as bpm, 0 until the flux history is filled.
+        """
+        if dt is not None:
+            self._frame_time += 0.05 * (dt - self._frame_time)
+            if abs(self._frame_time * self.frame_rate - 1.0) > 0.01:
+                self._set_frame_rate(1.0 / self._frame_time)
+        flux = self._spectral_flux(pow_spectrum)
+        self._history.write(np.array([flux]))
+        self._num_frames += 1
+        history = self._history.read(self._flux)
+        recent = history[-self._threshold_frames - 1:-1]
+        mean = np.mean(recent)
+        onset = (self._num_frames > self._threshold_frames
+                 and flux > mean + self.threshold * np.std(recent)
+                 and flux > 2.0 * mean
+                 and self._num_frames - self._last_onset >= self._min_onset_frames)
+        if onset:
+            self._last_onset = self._num_frames
+        if self._num_frames >= len(self._history):
+            self.bpm = self._estimate_tempo(history)
+        if self.bpm <= 0.0:
+            return flux, onset, onset
+        # beat phase, a beat is due at phase 1
+        beat_frames = 60.0 * self.frame_rate / self.bpm
+        self._phase += 1.0 / beat_frames
+        beat = False
+        if self._phase >= 1.0 - 0.5 / beat_frames:
+            # frame closest to the beat
+            beat = True
+            self._phase -= 1.0
+        if onset and (self._phase >= 0.75 or self._phase < 0.25):
+            # onset close to the beat, realign and only count it if the beat wasn't already given
+            beat = beat or self._num_frames - self._last_beat >= 0.5 * beat_frames
+            self._phase = 0.0
+        if beat:
+            self._last_beat = self._num_frames
+        return flux, onset, beat
@@ -1,4 +1,26 @@
 import inspect
+import numpy as np
+
+
+class BufferSpec(object):
+    """
+    Shape and dtype of the data on a channel, e.g. (3, num_pixels) for pixel arrays
+    or (num_samples,) for audio chunks.
+    """
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    def __eq__(self, other):
+        return isinstance(other, BufferSpec) and self.shape == other.shape and self.dtype == other.dtype
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "BufferSpec({}, {})".format(self.shape, self.dtype)
+
+
 class Effect(object):
     """
     Base class for effects
@@ -9,6 +31,9 @@ class Effect(object):
     Input values can be accessed by self._inputBuffer[channelNumber], output values
     are to be written into self_outputBuffer[channelNumber].
     """
+    # incremented whenever the parameters of an effect change
+    stateRevision = 0
+
     def __init__(self):
         self.__initstate__()
 
@@ -22,6 +47,18 @@ class Effect(object):
             self._outputBuffer
         except AttributeError:
             self._outputBuffer = None
+        try:
+            self._outputArrays
+        except AttributeError:
+            self._outputArrays = {}
+        try:
+            self._bufferPool
+        except AttributeError:
+            self._bufferPool = None
+        try:
+            self._inputSpecs
+        except AttributeError:
+            self._inputSpecs = None
         # make sure all default values are set (basic backwards compatibility)
         argspec = inspect.getargspec(self.__init__)
         if argspec.defaults is not None:
@@ -55,6 +92,38 @@ class Effect(object):
         """
         self._inputBuffer = buffer
 
+    def setBufferPool(self, pool):
+        """
+        Set pool that preallocated output arrays are taken from, see _getOutputArray
+        """
+        self._bufferPool = pool
+
+    def releaseOutputArrays(self):
+        """
+        Return all preallocated output arrays to the buffer pool
+        """
+        if self._bufferPool is not None:
+            for array in self._outputArrays.values():
+                self._bufferPool.put(array)
+        self._outputArrays = {}
+
+    def inferOutputSpecs(self, inputSpecs):
+        """
+        Returns a list with the BufferSpec of every output channel, given the BufferSpecs
+        of the input channels. Specs of unconnected inputs are None, as are unknown specs.
+
+        Raises ValueError if the effect can't process the given inputs.
+        The default implementation doesn't know its output specs.
+        """
+        return [None for i in range(0, self.numOutputChannels())]
+
+    def setInputSpecs(self, inputSpecs):
+        """
+        Called by the filter graph with the inferred input specs,
+        effects can override this to allocate their state once at the right size.
+        """
+        self._inputSpecs = inputSpecs
+
     def process(self):
         """
         The main processing function:
@@ -70,6 +139,21 @@ class Effect(object):
         """
         self._t += dt
 
+    def isTimeInvariant(self):
+        """
+        Returns True if the outputs only depend on the parameters and the inputs, not on time or internal state.
+        The filter graph keeps the outputs of time invariant effects with static inputs
+        and skips update() and process() until a parameter changes.
+        """
+        return False
+
+    def needsAsyncUpdate(self):
+        """
+        Returns True if update() awaits asynchronous work and needs to run on the event loop.
+        Otherwise the filter graph runs update() synchronously without an event loop.
+        """
+        return False
+
     def __cleanState__(self, stateDict):
         """
         Cleans given state dictionary from state objects beginning with __
@@ -90,6 +174,7 @@ class Effect(object):
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.__initstate__()
+        Effect.stateRevision += 1
 
     def updateParameter(self, stateDict):
         self.__setstate__(stateDict)
@@ -101,6 +186,60 @@ class Effect(object):
     def getParameterDefinition():
         return {}
 
+    def _getOutputArray(self, channel, shape, dtype=np.float32):
+        """
+        Returns a preallocated array for output channel `channel` to be used with out= semantics.
+
+        Effects opt in to preallocated outputs by writing their results into this array.
+        The array is reused across frames as long as shape and dtype don't change,
+        so it has to be overwritten completely on every process().
+        """
+        out = self._outputArrays.get(channel)
+        if out is None or out.shape != shape or out.dtype != dtype:
+            if self._bufferPool is not None:
+                if out is not None:
+                    self._bufferPool.put(out)
+                out = self._bufferPool.get(shape, dtype)
+            else:
+                out = np.empty(shape, dtype=dtype)
+            self._outputArrays[channel] = out
+        return out
+
+    def _checkPixelSpec(self, inputSpecs, channel, num_pixels=None):
+        """
+        Raises ValueError if input `channel` has a known spec that isn't a (3, N) pixel array.
+        If num_pixels is given, N has to be either 1 or num_pixels.
+        """
+        spec = inputSpecs[channel] if len(inputSpecs) > channel else None
+        if spec is None:
+            return
+        if len(spec.shape) != 2 or spec.shape[0] != 3:
+            raise ValueError("Input {} expects (3, N) pixels, got shape {}".format(channel, spec.shape))
+        if spec.dtype.kind not in 'iuf':
+            raise ValueError("Input {} expects numeric pixels, got dtype {}".format(channel, spec.dtype))
+        if num_pixels is not None and spec.shape[1] not in (1, num_pixels):
+            raise ValueError("Input {} expects {} pixels, got {}".format(channel, num_pixels, spec.shape[1]))
+
+    def _checkVectorSpec(self, inputSpecs, channel, kind):
+        """
+        Raises ValueError if input `channel` has a known spec that isn't a 1D floating point array.
+        `kind` describes the expected values in the error message, e.g. 'audio samples'.
+        """
+        spec = inputSpecs[channel] if len(inputSpecs) > channel else None
+        if spec is None:
+            return
+        if len(spec.shape) != 1:
+            raise ValueError("Input {} expects {}, got shape {}".format(channel, kind, spec.shape))
+        if spec.dtype.kind != 'f':
+            raise ValueError("Input {} expects floating point {}, got dtype {}".format(channel, kind, spec.dtype))
+
+    def _inputSpecKnown(self, channel):
+        """
+        Returns True if the filter graph told the effect the spec of input `channel`, see setInputSpecs.
+        Effects set up their state for known specs once and only check inputs with unknown specs per frame.
+        """
+        return self._inputSpecs is not None and len(self._inputSpecs) > channel and self._inputSpecs[channel] is not None
+
     def _inputBufferValid(self, index):
         if self._inputBuffer is None:
             return False
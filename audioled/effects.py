@@ -15,7 +15,7 @@ from scipy.signal import lfilter
 import audioled.dsp as dsp
 import audioled.colors as colors
 import audioled.filtergraph as filtergraph
-from audioled.effect import Effect
+from audioled.effect import Effect, BufferSpec
 
 SHORT_NORMALIZE = 1.0 / 32768.0
 
@@ -60,6 +60,10 @@ class Shift(Effect):
         definition['parameters']['speed'][0] = self.speed
         return definition
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        return [inputSpecs[0]]
+
     def process(self):
         if self._inputBuffer is None or self._outputBuffer is None:
             return
@@ -130,6 +134,20 @@ class Append(Effect):
         definition['parameters']['flip7'] = self.flip7
         return definition
 
+    def inferOutputSpecs(self, inputSpecs):
+        num_pixels = 0
+        for i in range(0, self.num_channels):
+            self._checkPixelSpec(inputSpecs, i)
+            if inputSpecs[i] is not None:
+                num_pixels += inputSpecs[i].shape[1]
+        if any(spec is None for spec in inputSpecs):
+            # output depends on unknown inputs
+            return [None]
+        return [BufferSpec((3, num_pixels), np.float32)]
+
+    def isTimeInvariant(self):
+        return True
+
     def process(self):
         if self._inputBuffer is None or self._outputBuffer is None:
             self._outputBuffer[0] = None
@@ -137,13 +155,21 @@ class Append(Effect):
         if self._inputBuffer[0] is None:
             self._outputBuffer[0] = None
             return
-        state = np.zeros((3,0))
+        inputs = []
         for i in range(0,self.num_channels):
             if self._inputBuffer[i] is not None:
-                if self._flipMask is not None and self._flipMask[i] > 0:
-                    state = np.concatenate((state, self._inputBuffer[i][:,::-1]),axis=1)
-                else:
-                    state = np.concatenate((state, self._inputBuffer[i]),axis=1)
+                flip = self._flipMask is not None and self._flipMask[i] > 0
+                inputs.append((self._inputBuffer[i], flip))
+        num_pixels = sum(np.size(y, axis=1) for y, flip in inputs)
+        state = self._getOutputArray(0, (3, num_pixels))
+        offset = 0
+        for y, flip in inputs:
+            n = np.size(y, axis=1)
+            if flip:
+                state[:,offset:offset + n] = y[:,::-1]
+            else:
+                state[:,offset:offset + n] = y
+            offset += n
         self._outputBuffer[0] = state
 
 class Combine(Effect):
@@ -171,6 +197,22 @@ class Combine(Effect):
         definition['parameters']['mode'] = [self.mode] + [x for x in colors.blend_modes if x!=self.mode]
         return definition
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        self._checkPixelSpec(inputSpecs, 1)
+        a, b = inputSpecs[0], inputSpecs[1]
+        if a is None or b is None:
+            # only one input is passed through
+            return [a if b is None else b]
+        try:
+            shape = np.broadcast(np.empty(a.shape), np.empty(b.shape)).shape
+        except ValueError:
+            raise ValueError("Can't combine inputs of shape {} and {}".format(a.shape, b.shape))
+        return [BufferSpec(shape, np.float32)]
+
+    def isTimeInvariant(self):
+        return True
+
     def process(self):
         if self._inputBuffer is None or self._outputBuffer is None:
             return
@@ -179,13 +221,15 @@ class Combine(Effect):
             self._outputBuffer[0] = None
         elif self._inputBufferValid(0) and self._inputBufferValid(1):
             # input on both channels
-            self._outputBuffer[0] = colors.blend(self._inputBuffer[0], self._inputBuffer[1], self.mode)
+            a, b = self._inputBuffer[0], self._inputBuffer[1]
+            out = self._getOutputArray(0, np.broadcast(a, b).shape)
+            self._outputBuffer[0] = colors.blend(a, b, self.mode, out=out)
         elif self._inputBufferValid(0):
             # only channel 0 valid
             self._outputBuffer[0] = self._inputBuffer[0]
         elif self._inputBufferValid(1):
             # only channel 1 valid
-            self._outputBuffer[0] = self._inputBuffer[0]
+            self._outputBuffer[0] = self._inputBuffer[1]
         else:
             self._outputBuffer[0] = None
 
@@ -226,6 +270,17 @@ class AfterGlow(Effect):
         definition['parameters']['glow_time'][0] = self.glow_time
         return definition
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        if inputSpecs[0] is None:
+            return [None]
+        return [BufferSpec(inputSpecs[0].shape, np.float32)]
+
+    def setInputSpecs(self, inputSpecs):
+        super(AfterGlow, self).setInputSpecs(inputSpecs)
+        if inputSpecs[0] is not None and self._pixel_state is not None and self._pixel_state.shape != inputSpecs[0].shape:
+            self._pixel_state = None
+
     async def update(self, dt):
         await super().update(dt)
         dt = self._t - self._last_t
@@ -234,7 +289,7 @@ class AfterGlow(Effect):
         if dt > 0:
             # Dim state
             if self.glow_time > 0 and self._pixel_state is not None:
-                self._pixel_state = self._pixel_state * (1.0 - dt / self.glow_time)
+                self._pixel_state *= (1.0 - dt / self.glow_time)
             else:
                 self._pixel_state = None
 
@@ -247,16 +302,24 @@ class AfterGlow(Effect):
             self._outputBuffer[0] = None
             return
 
-        if self._pixel_state is not None and np.size(self._pixel_state) == np.size(y):
+        out = self._getOutputArray(0, np.shape(y))
+        out[...] = y
+        if self._pixel_state is not None and not self._inputSpecKnown(0) and self._pixel_state.shape != out.shape:
+            # the size of inputs with unknown spec may change at any time
+            self._pixel_state = None
+        if self._pixel_state is not None:
             # keep previous state if new color is too dark
             diff = np.nan_to_num((y - self._pixel_state).max(axis=0))
             mask = diff < 10
 
-            y[:, mask] = self._pixel_state[:, mask]
-
-        self._pixel_state = y.clip(0.0, 255.0)
+            out[:, mask] = self._pixel_state[:, mask]
+            np.clip(out, 0.0, 255.0, out=out)
+            self._pixel_state[...] = out
+        else:
+            np.clip(out, 0.0, 255.0, out=out)
+            self._pixel_state = out.copy()
 
-        self._outputBuffer[0] = y.clip(0.0, 255.0)
+        self._outputBuffer[0] = out
 
 class Mirror(Effect):
 
@@ -294,24 +357,41 @@ class Mirror(Effect):
         definition['parameters']['recursion'][0] = self.recursion
         return definition
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0)
+        return [inputSpecs[0]]
+
+    def isTimeInvariant(self):
+        return True
+
+    def setInputSpecs(self, inputSpecs):
+        super(Mirror, self).setInputSpecs(inputSpecs)
+        if inputSpecs[0] is not None:
+            self._genMaps(inputSpecs[0].shape[1])
+
+    def _genMaps(self, num_pixels):
+        if self._mirrorLower is None or np.size(self._mirrorLower,1) != num_pixels:
+            self._mirrorLower = self._genMirrorLowerMap(num_pixels,self.recursion)
+            self._mirrorUpper = self._genMirrorUpperMap(num_pixels,self.recursion)
+
     def process(self):
         if self._inputBuffer is None or self._outputBuffer is None:
             return
         if not self._inputBufferValid(0):
             self._outputBuffer[0] = None
             return
-        num_pixels = np.size(self._inputBuffer[0], 1)
-        if self._mirrorLower is None or np.size(self._mirrorLower,1) != num_pixels:
-            self._mirrorLower = self._genMirrorLowerMap(num_pixels,self.recursion)
-        if self._mirrorUpper is None or np.size(self._mirrorUpper,1) != num_pixels:
-            self._mirrorUpper = self._genMirrorUpperMap(num_pixels,self.recursion)
         buffer = self._inputBuffer[0]
+        if self._mirrorLower is None or not self._inputSpecKnown(0):
+            self._genMaps(np.size(buffer, 1))
+        # np.take only writes into arrays of the input dtype
+        out = self._getOutputArray(0, np.shape(buffer), buffer.dtype)
         # 0 .. h .. n
         #   h    n-h
+        # maps only move pixels within their color row
         if self.mirror_lower:
-            self._outputBuffer[0] = buffer[self._mirrorLower[:,:,0],self._mirrorLower[:,:,1]]
+            self._outputBuffer[0] = np.take(buffer, self._mirrorLower[0,:,1], axis=1, out=out)
         else:
-            self._outputBuffer[0] = buffer[self._mirrorUpper[:,:,0],self._mirrorUpper[:,:,1]]
+            self._outputBuffer[0] = np.take(buffer, self._mirrorUpper[0,:,1], axis=1, out=out)
 
     def _genMirrorLowerMap(self, n, recursion):
         h = int(n/2)
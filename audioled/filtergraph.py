@@ -1,8 +1,24 @@
 import asyncio
+import collections
+import concurrent.futures
+import numbers
+import os
+import threading
 from timeit import default_timer as timer
 import numpy as np
 import uuid
 import jsonpickle
+from audioled.effect import Effect
+
+def _runSync(coroutine):
+    """Runs a coroutine that doesn't await any asynchronous work without an event loop"""
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        return
+    coroutine.close()
+    raise RuntimeError("update() awaited asynchronous work, but needsAsyncUpdate() returned False")
+
 
 class NodeException(Exception):
     def __init__(self, message, node, error):
@@ -16,6 +32,8 @@ class Node(object):
     def __init__(self, effect):
         self.effect = effect
         self.uid = None
+        # execution rate in Hz, None runs the node every frame
+        self.rate = None
         # TODO: Improve consistency with numInputChannels and numOutputChannels
         self.numInputChannels = 0
         self.numOutputChannels = 0
@@ -26,14 +44,23 @@ class Node(object):
     def __initstate__(self):
         self._outputBuffer = [None for i in range(0, self.effect.numOutputChannels())]
         self._inputBuffer = [None for i in range(0, self.effect.numInputChannels())]
-        self._incomingConnections = []
+        # connections by uid
+        self._incomingConnections = {}
+        self._outgoingConnections = {}
+        self._outputSpecs = [None for i in range(0, self.effect.numOutputChannels())]
+        # kept across compilations of the filter graph, see FilterGraph._compile
+        self._rateLimiter = None
+        try:
+            self.rate
+        except AttributeError:
+            self.rate = None
 
         self.effect.setOutputBuffer(self._outputBuffer)
         self.effect.setInputBuffer(self._inputBuffer)
 
     def process(self):
         # propagate values
-        for con in self._incomingConnections:
+        for con in self._incomingConnections.values():
             self._inputBuffer[con.toChannel] = con.fromNode._outputBuffer[con.fromChannel]
         # process
         self.effect.process()
@@ -61,6 +88,9 @@ class Node(object):
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.__initstate__()
+        # effects may have gained channels since the state was saved
+        self.numInputChannels = self.effect.numInputChannels()
+        self.numOutputChannels = self.effect.numOutputChannels()
 
 class Connection(object):
 
@@ -81,64 +111,360 @@ class Connection(object):
         return state
         
 
+class _RateLimiter(object):
+    """Runs an effect at a lower rate than the filter graph
+
+    The outputs of the effect are held between runs. update() is called
+    with the time elapsed since the last run.
+    """
+
+    def __init__(self, effect, rate):
+        self.effect = effect
+        self.rate = rate
+        self._period = 1.0 / rate
+        # first frame is due
+        self._phase = self._period
+        self._elapsed = 0.0
+        self._due = True
+
+    async def update(self, dt):
+        self._phase += dt
+        self._elapsed += dt
+        self._due = self._phase >= self._period
+        if self._due:
+            # keep the remainder, but don't catch up on missed runs
+            self._phase = min(self._phase - self._period, self._period)
+            elapsed = self._elapsed
+            self._elapsed = 0.0
+            await self.effect.update(elapsed)
+
+    def process(self):
+        if self._due:
+            self.effect.process()
+
+
 class Timing(object):
-    def __init__(self):
+    """Collects timings in seconds over a sliding window
+
+    The latest `window` samples are kept in a ring buffer to compute percentiles,
+    _min and _max cover all samples, _avg is the mean over the window.
+    """
+    def __init__(self, window=1000):
         self._max = None
         self._min = None
         self._avg = None
         self._count = 0
-    
+        self._samples = np.zeros(window)
+        self._index = 0
+        self._sum = 0.0
+
     def update(self, timing):
         if self._count == 0:
             self._max = timing
             self._min = timing
-            self._avg = timing
         else:
             self._max = max(self._max, timing)
             self._min = min(self._min, timing)
-            self._avg = (self._avg * self._count + timing) / (self._count + 1)
-        self._count = self._count + 1
-        self._count = min(100, self._count)
+        if self._count < len(self._samples):
+            self._count = self._count + 1
+        # replace oldest sample
+        self._sum += timing - self._samples[self._index]
+        self._samples[self._index] = timing
+        self._index = (self._index + 1) % len(self._samples)
+        if self._index == 0:
+            # avoid drift of the running sum
+            self._sum = float(np.sum(self._samples))
+        self._avg = self._sum / self._count
+
+    def percentile(self, q):
+        """Returns the q-th percentile of the window or None if there are no samples"""
+        if self._count == 0:
+            return None
+        return float(np.percentile(self._samples[:self._count], q))
+
+    def getStats(self):
+        """Returns count, avg, p50, p95, p99 and max over the window"""
+        if self._count == 0:
+            return {'count': 0}
+        window = self._samples[:self._count]
+        p50, p95, p99 = np.percentile(window, [50, 95, 99])
+        return {
+            'count': self._count,
+            'avg': self._avg,
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'max': float(np.max(window)),
+        }
+
+
+# thread pool shared by all graphs processing in parallel
+_threadPool = None
+
+
+def _getThreadPool():
+    global _threadPool
+    if _threadPool is None:
+        _threadPool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _threadPool
+
+
+class BufferPool(object):
+    """Recycles the preallocated output arrays of effects
+
+    Arrays are kept by shape and dtype, so arrays freed by removed nodes
+    are reused by nodes added later.
+    The pool is locked, effects processed in parallel take arrays from it concurrently.
+    """
+
+    def __init__(self):
+        self._free = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def get(self, shape, dtype=np.float32):
+        with self._lock:
+            free = self._free.get((tuple(shape), np.dtype(dtype)))
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=dtype)
+
+    def put(self, array):
+        with self._lock:
+            self._free[(array.shape, array.dtype)].append(array)
 
 
 class FilterGraph(object):
 
-    def __init__(self, recordTimings=False):
+    def __init__(self, recordTimings=False, parallelProcessing=False):
         self.recordTimings=recordTimings
-        self._filterConnections = []
-        self._filterNodes = []
-        self._processOrder = []
+        self.parallelProcessing = parallelProcessing
+        # nodes and connections by uid, in insertion order
+        self._nodesByUid = {}
+        self._nodesByEffect = {}
+        self._connectionsByUid = {}
+        # rank of every node in the process order, the keys are kept sorted by rank
+        self._processIndex = {}
+        self._nextProcessIndex = 0
         self._updateTimings = {}
         self._processTimings = {}
+        self._frameTiming = Timing()
+        self._frameStart = None
+        self._bufferPool = BufferPool()
+        self._executionPlan = None
+        self._executionLevels = None
+        self._syncUpdates = None
+        self._asyncUpdates = None
+        self._foldedPlan = None
+        self._updatedSinceCompile = False
+        self._effectRevision = None
         #self._asyncLoop = asyncio.get_event_loop()
         #self._asyncLoop = asyncio.new_event_loop()
         #asyncio.set_event_loop(self._asyncLoop)
 
-    def update(self, dt, event_loop = asyncio.get_event_loop()):
+    def update(self, dt, event_loop=None):
+        if self.recordTimings:
+            self._frameStart = timer()
+        if self._executionPlan is None or self._effectRevision != Effect.stateRevision:
+            self._compile()
+        # synchronous updates run in a plain loop
+        node = None
+        try:
+            if self.recordTimings:
+                for node, effect in self._syncUpdates:
+                    time = timer()
+                    _runSync(effect.update(dt))
+                    self.updateUpdateTiming(node, timer() - time)
+            else:
+                for node, effect in self._syncUpdates:
+                    _runSync(effect.update(dt))
+        except Exception as e:
+            raise NodeException("{}".format(e), node, e)
+        self._updatedSinceCompile = True
+        if not self._asyncUpdates:
+            return
         # gather all async updates
+        if event_loop is None:
+            event_loop = asyncio.get_event_loop()
         asyncio.set_event_loop(event_loop)
         async def handle_async_exception(node, func, param):
+            time = timer()
             try:
                 await func(param)
             except Exception as e:
                 raise NodeException("{}".format(e), node, e)
-        all_tasks = asyncio.gather(*[asyncio.ensure_future(handle_async_exception(node, node.update, dt)) for node in self._processOrder])
+            if self.recordTimings:
+                # includes time spent waiting for other updates
+                self.updateUpdateTiming(node, timer() - time)
+        all_tasks = asyncio.gather(*[asyncio.ensure_future(handle_async_exception(node, effect.update, dt)) for node, effect in self._asyncUpdates])
         # wait for completion
         event_loop.run_until_complete(all_tasks)
     
 
     def process(self):
-        time = None
-
-        for node in self._processOrder:
+        if self._executionPlan is None or self._effectRevision != Effect.stateRevision:
+            self._compile()
+        if self.parallelProcessing:
+            self._processParallel(self._executionLevels)
+        elif self.recordTimings:
+            self._processTimed(self._executionPlan)
+        else:
+            node = None
             try:
-                if self.recordTimings:
-                    time = timer()
-                node.process()
-                if self.recordTimings:
-                    self.updateProcessTiming(node, timer() - time)
+                for node, effect, inputBuffer, links in self._executionPlan:
+                    for toChannel, outputBuffer, fromChannel in links:
+                        inputBuffer[toChannel] = outputBuffer[fromChannel]
+                    effect.process()
             except Exception as e:
                 raise NodeException("{}".format(e), node, e)
+        if self.recordTimings and self._frameStart is not None:
+            # update and process, including device output
+            self._frameTiming.update(timer() - self._frameStart)
+            self._frameStart = None
+        if self._foldedPlan is not None and self._updatedSinceCompile:
+            # static nodes have been updated and processed once, their outputs are kept from now on
+            self._executionPlan, self._executionLevels, self._syncUpdates, self._asyncUpdates = self._foldedPlan
+            self._foldedPlan = None
+
+    def _processTimed(self, plan):
+        node = None
+        try:
+            for node, effect, inputBuffer, links in plan:
+                time = timer()
+                for toChannel, outputBuffer, fromChannel in links:
+                    inputBuffer[toChannel] = outputBuffer[fromChannel]
+                effect.process()
+                self.updateProcessTiming(node, timer() - time)
+        except Exception as e:
+            raise NodeException("{}".format(e), node, e)
+
+    def _processStep(self, step):
+        node, effect, inputBuffer, links = step
+        time = timer() if self.recordTimings else None
+        for toChannel, outputBuffer, fromChannel in links:
+            inputBuffer[toChannel] = outputBuffer[fromChannel]
+        effect.process()
+        if time is not None:
+            self.updateProcessTiming(node, timer() - time)
+
+    def _processParallel(self, levels):
+        """Processes the nodes of each dependency level on the shared thread pool
+
+        numpy and scipy release the GIL in most heavy calls, so independent
+        branches of the graph can run concurrently.
+        """
+        pool = _getThreadPool()
+        for level in levels:
+            if len(level) == 1:
+                try:
+                    self._processStep(level[0])
+                except Exception as e:
+                    raise NodeException("{}".format(e), level[0][0], e)
+                continue
+            futures = [pool.submit(self._processStep, step) for step in level]
+            concurrent.futures.wait(futures)
+            for step, future in zip(level, futures):
+                e = future.exception()
+                if e is not None:
+                    raise NodeException("{}".format(e), step[0], e)
+
+    def _compile(self):
+        if self._effectRevision != Effect.stateRevision:
+            # changed parameters can change the output specs, e.g. the number of pixels
+            self._inferSpecs(strict=False)
+        self._effectRevision = Effect.stateRevision
+        self._updatedSinceCompile = False
+        # nodes with a rate are run through a rate limiter, it keeps its timing until the rate changes
+        effects = {}
+        for node in self._processOrder:
+            if not node.rate:
+                node._rateLimiter = None
+                effects[node] = node.effect
+                continue
+            if node._rateLimiter is None or node._rateLimiter.rate != node.rate:
+                node._rateLimiter = _RateLimiter(node.effect, node.rate)
+            effects[node] = node._rateLimiter
+        self._executionPlan = self._compileExecutionPlan(effects)
+        self._executionLevels = self._compileExecutionLevels(self._executionPlan)
+        self._syncUpdates, self._asyncUpdates = self._compileUpdates(self._processOrder, effects)
+        # the first frame runs all nodes, afterwards static nodes are skipped
+        staticNodes = self._findStaticNodes()
+        if staticNodes:
+            foldedPlan = [step for step in self._executionPlan if step[0] not in staticNodes]
+            self._foldedPlan = (foldedPlan, self._compileExecutionLevels(foldedPlan)) + self._compileUpdates(
+                [node for node in self._processOrder if node not in staticNodes], effects)
+        else:
+            self._foldedPlan = None
+
+    def _compileUpdates(self, nodes, effects):
+        """Splits the nodes to update into synchronous and asynchronous (node, effect) updates
+
+        Effects need to declare asynchronous updates, see Effect.needsAsyncUpdate.
+        """
+        syncUpdates = []
+        asyncUpdates = []
+        for node in nodes:
+            needsAsyncUpdate = getattr(node.effect, 'needsAsyncUpdate', None)
+            if needsAsyncUpdate is None or needsAsyncUpdate():
+                asyncUpdates.append((node, effects[node]))
+            else:
+                syncUpdates.append((node, effects[node]))
+        return syncUpdates, asyncUpdates
+
+    def _findStaticNodes(self):
+        """Returns the nodes whose outputs don't change until a parameter changes
+
+        A node is static if its effect is time invariant and all its inputs come from static nodes.
+        """
+        staticNodes = set()
+        for node in self._processOrder:
+            isTimeInvariant = getattr(node.effect, 'isTimeInvariant', None)
+            if isTimeInvariant is None or not isTimeInvariant():
+                continue
+            if all(con.fromNode in staticNodes for con in node._incomingConnections.values()):
+                staticNodes.add(node)
+        return staticNodes
+
+    def _compileExecutionLevels(self, plan):
+        """Partitions the execution plan into dependency levels
+
+        Nodes of the same level don't depend on each other and can be processed concurrently.
+        """
+        nodeLevels = {}
+        levels = []
+        for step in plan:
+            node = step[0]
+            level = max([nodeLevels.get(con.fromNode, -1) + 1 for con in node._incomingConnections.values()] + [0])
+            nodeLevels[node] = level
+            while len(levels) <= level:
+                levels.append([])
+            levels[level].append(step)
+        return levels
+
+    def _compileExecutionPlan(self, effects):
+        """Compiles the process order into a flat execution plan
+
+        Every step of the plan consists of the node, its effect (or rate limiter), its input buffer
+        and the (toChannel, outputBuffer, fromChannel) slots to copy before processing.
+        Nodes whose outputs don't reach any sink (node without output channels)
+        are pruned from the plan.
+        """
+        # walk upstream from all sinks to find the nodes that need processing
+        liveNodes = set()
+        work = [node for node in self._nodesByUid.values() if node.numOutputChannels == 0]
+        while work:
+            node = work.pop()
+            if node in liveNodes:
+                continue
+            liveNodes.add(node)
+            work.extend(con.fromNode for con in node._incomingConnections.values())
+
+        plan = []
+        for node in self._processOrder:
+            if node not in liveNodes:
+                continue
+            links = tuple((con.toChannel, con.fromNode._outputBuffer, con.fromChannel) for con in node._incomingConnections.values())
+            plan.append((node, effects[node], node._inputBuffer, links))
+        return plan
 
     def updateProcessTiming(self,node,timing):
         if not node in self._processTimings:
@@ -152,21 +478,38 @@ class FilterGraph(object):
         
         self._updateTimings[node].update(timing)
 
+    def getTimings(self):
+        """Returns the timing statistics of the frames and of the update and process calls of every node
+
+        Node timings are keyed by node uid, see Timing.getStats.
+        """
+        def nodeStats(timings):
+            return {node.uid: dict(val.getStats(), effect=type(node.effect).__name__) for node, val in list(timings.items())}
+        return {
+            'frame': self._frameTiming.getStats(),
+            'update': nodeStats(self._updateTimings),
+            'process': nodeStats(self._processTimings),
+        }
+
     def printUpdateTimings(self):
-        if self._updateTimings is None:
+        if not self._updateTimings:
             print("No metrics collected")
             return
         print("Update timings:")
-        for key, val in self._updateTimings.items():
-            print("{0}: min {1:1.8f}, max {2:1.8f}, avg {3:1.8f}".format(key.effect, val._min, val._max, val._avg))
+        self._printTimings(self._updateTimings)
     
     def printProcessTimings(self):
-        if self._processTimings is None:
+        if not self._processTimings:
             print("No metrics collected")
             return
         print("Process timings:")
-        for key, val in self._processTimings.items():
-            print("{0:30s}: min {1:1.8f}, max {2:1.8f}, avg {3:1.8f}".format(str(key.effect)[0:30], val._min, val._max, val._avg))
+        self._printTimings(self._processTimings)
+
+    def _printTimings(self, timings):
+        for key, val in list(timings.items()):
+            stats = val.getStats()
+            print("{0:30s}: p50 {1:1.8f}, p95 {2:1.8f}, p99 {3:1.8f}, max {4:1.8f}, avg {5:1.8f}".format(
+                str(key.effect)[0:30], stats['p50'], stats['p95'], stats['p99'], stats['max'], stats['avg']))
 
 
     def addEffectNode(self, effect):
@@ -177,10 +520,12 @@ class FilterGraph(object):
         filterNode: node to add
         """
         print("add node {}".format(effect))
-        node = Node(effect)
-        node.uid = uuid.uuid4().hex
-        self._filterNodes.append(node)
-        self._updateProcessOrder()
+        node = self._addNode(effect, uuid.uuid4().hex)
+        # a new node has no connections, so appending keeps the order valid
+        self._processIndex[node] = self._nextProcessIndex
+        self._nextProcessIndex += 1
+        self._executionPlan = None
+        self._inferSpecs(strict=False)
         return node
 
     def removeEffectNode(self, effect):
@@ -190,125 +535,229 @@ class FilterGraph(object):
         ----------
         filterNode: node to remove
         """
+        node = self._nodesByEffect[id(effect)]
         # Remove connections
-        connections = [con for con in self._filterConnections if con.fromNode.effect == effect or con.toNode.effect == effect]
-        for con in connections:
-            self._filterConnections.remove(con)
+        for con in list(node._incomingConnections.values()) + list(node._outgoingConnections.values()):
+            self._removeConnection(con)
         # Remove Node
-        node = next(node for node in self._filterNodes if node.effect == effect)
-        if node != None:
-            self._filterNodes.remove(node)
-            self._processOrder.remove(node)
-        
+        if hasattr(effect, 'releaseOutputArrays'):
+            effect.releaseOutputArrays()
+        if hasattr(effect, 'close'):
+            effect.close()
+        self._updateTimings.pop(node, None)
+        self._processTimings.pop(node, None)
+        del self._nodesByUid[node.uid]
+        del self._nodesByEffect[id(effect)]
+        # removing a node keeps the order valid
+        del self._processIndex[node]
+        self._executionPlan = None
+        self._inferSpecs(strict=False)
+
+    def close(self):
+        """Closes the effects of the graph that hold resources, e.g. the audio streams of audio inputs"""
+        for node in self._nodesByUid.values():
+            if hasattr(node.effect, 'close'):
+                node.effect.close()
 
     def addConnection(self, fromEffect, fromEffectChannel, toEffect, toEffectChannel):
         """Adds a connection between two filters
         """
-        # find fromNode
-        fromNode = next(node for node in self._filterNodes if node.effect == fromEffect)
-        # find toNode
-        toNode = next(node for node in self._filterNodes if node.effect == toEffect)
-        # construct connection
-        newConnection = Connection(fromNode, fromEffectChannel, toNode, toEffectChannel)
-        newConnection.uid = uuid.uuid4().hex
-        self._filterConnections.append(newConnection)
-        toNode._incomingConnections.append(newConnection)
-        self._updateProcessOrder()
-        return newConnection
+        fromNode = self._nodesByEffect[id(fromEffect)]
+        toNode = self._nodesByEffect[id(toEffect)]
+        return self._connectNodes(fromNode, fromEffectChannel, toNode, toEffectChannel)
 
     def addNodeConnection(self, fromNodeUid, fromEffectChannel, toNodeUid, toEffectChannel):
         """Adds a connection between two filters based on node uid
         """
         print("add node connection from {} channel {} to {} channel {}".format(fromNodeUid,fromEffectChannel, toNodeUid, toEffectChannel))
-        fromNode = next(node for node in self._filterNodes if node.uid == fromNodeUid)
-        toNode = next(node for node in self._filterNodes if node.uid == toNodeUid)
-        newConnection = Connection(fromNode, fromEffectChannel, toNode, toEffectChannel)
-        newConnection.uid = uuid.uuid4().hex
-        self._filterConnections.append(newConnection)
-        toNode._incomingConnections.append(newConnection)
-        self._updateProcessOrder()
-        return newConnection
+        fromNode = self._nodesByUid[fromNodeUid]
+        toNode = self._nodesByUid[toNodeUid]
+        return self._connectNodes(fromNode, fromEffectChannel, toNode, toEffectChannel)
     
     def removeConnection(self, fromEffect, fromEffectChannel, toEffect, toEffectChannel):
         """Removes a connection between two filters
         """
         # find connection
-        con = next(con for con in self._filterConnections if con.fromNode.effect == fromEffect and con.toNode.effect == toEffect and con.fromChannel == fromEffectChannel and con.toChannel == toEffectChannel)
-        if con != None:
-            self._filterConnections.remove(con)
-            con.toNode._incomingConnections.remove(con)
-        None
-    
+        toNode = self._nodesByEffect[id(toEffect)]
+        con = next(con for con in toNode._incomingConnections.values() if con.fromNode.effect is fromEffect and con.fromChannel == fromEffectChannel and con.toChannel == toEffectChannel)
+        self._removeConnection(con)
+        self._executionPlan = None
+        self._inferSpecs(strict=False)
+
+    def removeNodeConnection(self, connectionUid):
+        """Removes a connection based on connection uid
+        """
+        self._removeConnection(self._connectionsByUid[connectionUid])
+        self._executionPlan = None
+        self._inferSpecs(strict=False)
+
+    def getNode(self, nodeUid):
+        """Returns the node with the given uid or None
+        """
+        return self._nodesByUid.get(nodeUid)
+
+    def getNodeForEffect(self, effect):
+        """Returns the node holding the given effect or None
+        """
+        return self._nodesByEffect.get(id(effect))
+
+    def setNodeRate(self, nodeUid, rate):
+        """Sets the execution rate of a node in Hz
+
+        The node is updated and processed at most `rate` times per second and holds its outputs in between.
+        None runs the node every frame.
+        """
+        node = self._nodesByUid[nodeUid]
+        if rate is not None and (isinstance(rate, bool) or not isinstance(rate, numbers.Real)):
+            raise ValueError("rate has to be a number or None, got {!r}".format(rate))
+        if rate is not None and not (0 < rate < float('inf')):
+            raise ValueError("rate has to be positive")
+        node.rate = rate
+        self._executionPlan = None
+
+    def getConnection(self, connectionUid):
+        """Returns the connection with the given uid or None
+        """
+        return self._connectionsByUid.get(connectionUid)
+
+    @property
+    def _filterNodes(self):
+        return list(self._nodesByUid.values())
+
+    @property
+    def _filterConnections(self):
+        return list(self._connectionsByUid.values())
+
+    @property
+    def _processOrder(self):
+        return list(self._processIndex)
+
+    def _addNode(self, effect, uid):
+        node = Node(effect)
+        node.uid = uid
+        if hasattr(effect, 'setBufferPool'):
+            effect.setBufferPool(self._bufferPool)
+        self._nodesByUid[uid] = node
+        self._nodesByEffect[id(effect)] = node
+        return node
+
+    def _addConnection(self, fromNode, fromChannel, toNode, toChannel, uid):
+        con = Connection(fromNode, fromChannel, toNode, toChannel)
+        con.uid = uid
+        self._connectionsByUid[uid] = con
+        toNode._incomingConnections[uid] = con
+        fromNode._outgoingConnections[uid] = con
+        return con
+
+    def _removeConnection(self, con):
+        del self._connectionsByUid[con.uid]
+        del con.toNode._incomingConnections[con.uid]
+        del con.fromNode._outgoingConnections[con.uid]
+        con.toNode._inputBuffer[con.toChannel] = None
+
+    def _connectNodes(self, fromNode, fromChannel, toNode, toChannel):
+        newConnection = self._addConnection(fromNode, fromChannel, toNode, toChannel, uuid.uuid4().hex)
+        self._executionPlan = None
+        try:
+            # a connection to the node itself is a cycle as well
+            if self._processIndex[fromNode] >= self._processIndex[toNode]:
+                self._updateProcessOrder()
+            self._inferSpecs()
+        except Exception:
+            # roll back connection
+            self._removeConnection(newConnection)
+            self._inferSpecs(strict=False)
+            raise
+        return newConnection
+
+    def _inferSpecs(self, strict=True):
+        """Propagates the BufferSpecs of all outputs through the graph
+
+        Every effect infers its output specs from the specs of its inputs, see Effect.inferOutputSpecs.
+        If an effect rejects its inputs a NodeException is raised in strict mode,
+        otherwise a warning is printed and the outputs of that node are treated as unknown.
+        Effects are told their input specs once the whole graph has been inferred.
+        """
+        inputSpecs = {}
+        outputSpecs = {}
+        for node in self._processOrder:
+            specs = [None for i in range(0, len(node._inputBuffer))]
+            for con in node._incomingConnections.values():
+                specs[con.toChannel] = outputSpecs[con.fromNode][con.fromChannel]
+            inputSpecs[node] = specs
+            outputSpecs[node] = [None for i in range(0, len(node._outputBuffer))]
+            if not hasattr(node.effect, 'inferOutputSpecs'):
+                continue
+            try:
+                outputSpecs[node] = node.effect.inferOutputSpecs(specs)
+            except ValueError as e:
+                if strict:
+                    raise NodeException("{}".format(e), node, e)
+                print("Inconsistent input for {}: {}".format(node.effect, e))
+        for node in self._processOrder:
+            node._outputSpecs = outputSpecs[node]
+            if hasattr(node.effect, 'setInputSpecs'):
+                node.effect.setInputSpecs(inputSpecs[node])
+
     def _updateProcessOrder(self):
-        # reset
-        self._processOrder = []
-        # find nodes without inputs
-        allNodes = self._filterNodes.copy()
-        for con in self._filterConnections:
-            if allNodes.count(con.toNode) > 0:
-                allNodes.remove(con.toNode)
-        
-        # Add those nodes first
-        for node in allNodes:
-            self._processOrder.append(node)
-        
-        #print("{} of {} nodes without inputs processed".format(len(self._processOrder), len(self._filterNodes)))
-
-        # Process others
-        connectionsToProcess = self._filterConnections.copy()
-        while len(connectionsToProcess) > 0:
-            nodesBefore = len(self._processOrder)
-            # find nodes with connections only relying on nodes already in chain
-            candidates = self._filterNodes.copy()
-            for node in self._processOrder:
-                candidates.remove(node)
-            
-            # if we find a connection with anything other than input nodes already processed, those are not candidates
-
-            for con in connectionsToProcess:
-                if self._processOrder.count(con.fromNode) <= 0 and candidates.count(con.toNode) > 0:
-                    candidates.remove(con.toNode)
-            
-            # append all candidates
-            for node in candidates:
-                self._processOrder.append(node)
-            
-            # update connections to process
-            for con in connectionsToProcess.copy():
-                if self._processOrder.count(con.fromNode) > 0 and self._processOrder.count(con.toNode) > 0:
-                    connectionsToProcess.remove(con)
-
-            #print("{} of {} nodes processed".format(len(self._processOrder), len(self._filterNodes)))
-
-            if len(self._processOrder) == nodesBefore:
-                print("circular graph detected")
-                raise RuntimeError("circular graph detected")
-
-        if len(self._processOrder) != len(self._filterNodes):
-            raise RuntimeError("not all nodes processed")
+        """Sorts the nodes topologically (Kahn's algorithm)
+
+        Runs in O(nodes + connections). Raises RuntimeError if the graph contains a cycle.
+        """
+        self._executionPlan = None
+        nodes = self._nodesByUid.values()
+        inDegree = {node: 0 for node in nodes}
+        successors = {node: [] for node in nodes}
+        for con in self._connectionsByUid.values():
+            successors[con.fromNode].append(con.toNode)
+            inDegree[con.toNode] += 1
+
+        # start with nodes without inputs
+        ready = collections.deque(node for node in nodes if inDegree[node] == 0)
+        processOrder = []
+        while ready:
+            node = ready.popleft()
+            processOrder.append(node)
+            for successor in successors[node]:
+                inDegree[successor] -= 1
+                if inDegree[successor] == 0:
+                    ready.append(successor)
+
+        if len(processOrder) != len(nodes):
+            print("circular graph detected")
+            raise RuntimeError("circular graph detected")
+        self._processIndex = {node: i for i, node in enumerate(processOrder)}
+        self._nextProcessIndex = len(processOrder)
 
     def __getstate__(self):
         state = {}
-        nodes = [node for node in self._filterNodes]
+        nodes = [node for node in self._nodesByUid.values()]
         state['nodes'] = nodes
         connections = []
-        for con in self._filterConnections:
+        for con in self._connectionsByUid.values():
             connections.append(con.__getstate__())
         state['connections'] = connections
         state['recordTimings'] = self.recordTimings
+        state['parallelProcessing'] = self.parallelProcessing
         return state
 
     def __setstate__(self, state):
         self.__init__()
         self.recordTimings = state['recordTimings']
+        self.parallelProcessing = state.get('parallelProcessing', False)
+        # bulk load nodes and connections, sort once at the end
         nodes = state['nodes']
+        nodesByUid = {}
         for node in nodes:
-            newnode = self.addEffectNode(node.effect)
-            newnode.uid = node.uid
+            nodesByUid[node.uid] = self._addNode(node.effect, node.uid)
+            nodesByUid[node.uid].rate = node.rate
         connections = state['connections']
         for con in connections:
             fromChannel = con['from_node_channel']
             toChannel = con['to_node_channel']
-            self.addNodeConnection(con['from_node_uid'], fromChannel, con['to_node_uid'], toChannel)
+            uid = con.get('uid') or uuid.uuid4().hex
+            self._addConnection(nodesByUid[con['from_node_uid']], fromChannel, nodesByUid[con['to_node_uid']], toChannel, uid)
+        self._updateProcessOrder()
+        self._inferSpecs(strict=False)
         
         
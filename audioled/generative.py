@@ -15,7 +15,7 @@ from scipy.signal import lfilter
 
 import audioled.dsp as dsp
 import audioled.filtergraph as filtergraph
-from audioled.effect import Effect
+from audioled.effect import Effect, BufferSpec
 
 
 class SwimmingPool(Effect):
@@ -90,6 +90,10 @@ class SwimmingPool(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        self._checkPixelSpec(inputSpecs, 0, self.num_pixels)
+        return [BufferSpec((3, self.num_pixels))]
+
     def process(self):
         if self._outputBuffer is not None:
             color = self._inputBuffer[0]
@@ -122,6 +126,9 @@ class DefenceMode(Effect):
     def numOutputChannels(self):
         return 1
 
+    def inferOutputSpecs(self, inputSpecs):
+        return [BufferSpec((3, self.num_pixels))]
+
     def process(self):
         if self._outputBuffer is not None:
             #color = self._inputBuffer[0]
@@ -0,0 +1,109 @@
+"""Offline rendering of filter graphs
+
+The filter graph is driven by a fixed-step clock instead of the wall clock
+and runs as fast as the CPU allows. Audio is read from a file and the frames
+sent to the LED outputs are recorded to a binary file, see devices.FrameRecorder.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import asyncio
+import random
+import struct
+import numpy as np
+import jsonpickle
+from audioled import audio
+from audioled import devices
+
+
+class FixedClock(object):
+    """Synthetic clock advancing by 1 / fps per frame"""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.frame = 0
+
+    def tick(self):
+        self.frame += 1
+
+    def __call__(self):
+        return self.frame / self.fps
+
+
+def render(fg, num_frames, fps=100.0, clock=None, recorder=None):
+    """Updates and processes the filter graph num_frames times with a time step of 1 / fps
+
+    The clock is advanced before every frame, the recorder is ticked after every frame.
+    """
+    dt = 1.0 / fps
+    event_loop = asyncio.new_event_loop()
+    try:
+        for i in range(0, num_frames):
+            if clock is not None:
+                clock.tick()
+            fg.update(dt, event_loop)
+            fg.process()
+            if recorder is not None:
+                recorder.tick()
+    finally:
+        event_loop.close()
+
+
+def render_config(config_path, output_path, duration=None, fps=100.0, audio_path=None, sample_rate=None, num_channels=1, seed=0):
+    """Renders a saved filter graph configuration to a frame file
+
+    AudioInput effects read from audio_path instead of the audio device, in sync with the clock.
+    The duration defaults to the length of the audio file.
+    Random generators are seeded, so rendering the same configuration gives the same frames.
+
+    Returns the number of recorded frames.
+    """
+    clock = FixedClock(fps)
+    source = None
+    if audio_path is not None:
+        samples, rate = audio.load_audio_file(audio_path, sample_rate, num_channels)
+        if duration is None:
+            duration = len(samples) / rate
+        source = _file_source(samples, rate, clock)
+    if duration is None:
+        raise ValueError("Duration is required without an audio file")
+    recorder = devices.FrameRecorder(output_path, fps)
+    random.seed(seed)
+    np.random.seed(seed)
+    override_device, override_source = devices.LEDOutput.overrideDevice, audio.AudioInput.overrideSource
+    devices.LEDOutput.overrideDevice = recorder
+    audio.AudioInput.overrideSource = source
+    try:
+        with open(config_path, "r", encoding='utf-8-sig') as f:
+            fg = jsonpickle.decode(f.read())
+        render(fg, int(round(duration * fps)), fps, clock, recorder)
+    finally:
+        devices.LEDOutput.overrideDevice = override_device
+        audio.AudioInput.overrideSource = override_source
+        recorder.close()
+    return recorder.frameCount
+
+
+def _file_source(samples, sample_rate, clock):
+    """Returns an AudioInput.overrideSource reading chunks from samples in sync with clock"""
+    def source(chunk_rate, channels):
+        return audio.file_audio_chunks(samples, sample_rate, chunk_rate, channels, clock=clock), sample_rate
+    return source
+
+
+def read_frames(path):
+    """Reads a frame file written by devices.FrameRecorder
+
+    Returns
+    -------
+    fps: float
+    frames: memory-mapped numpy.ndarray of shape (num_frames, num_pixels, 3) with uint8 RGB values
+    """
+    header_size = struct.calcsize(devices.FrameRecorder.HEADER_FORMAT)
+    with open(path, "rb") as f:
+        magic, num_pixels, fps = struct.unpack(devices.FrameRecorder.HEADER_FORMAT, f.read(header_size))
+    if magic != devices.FrameRecorder.FRAME_MAGIC:
+        raise ValueError("{} is not a frame file".format(path))
+    frames = np.memmap(path, dtype=np.uint8, mode='r', offset=header_size)
+    return fps, frames.reshape(-1, num_pixels, 3)
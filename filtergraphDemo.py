@@ -133,7 +133,7 @@ while True:
     cur_graph.process()
     if count == 100:
         cur_graph.printProcessTimings()
-        print(updateTiming.__dict__)
+        print(updateTiming.getStats())
         count = 0
     count = count + 1
     if dt < 0.015:
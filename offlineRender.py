@@ -0,0 +1,24 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+from timeit import default_timer as timer
+from audioled import offline
+
+parser = argparse.ArgumentParser(description='Render a filter graph configuration offline')
+parser.add_argument('config', help='filter graph configuration (json)')
+parser.add_argument('output', help='frame file to write')
+parser.add_argument('-a', '--audio', dest='audio', default=None, help='audio file to use instead of the audio device (.wav, .npy or raw float32)')
+parser.add_argument('-r', '--sample_rate', dest='sample_rate', type=int, default=None, help='sample rate of .npy and raw audio files')
+parser.add_argument('-c', '--channels', dest='channels', type=int, default=1, help='number of channels of raw audio files (default: 1)')
+parser.add_argument('-d', '--duration', dest='duration', type=float, default=None, help='duration in seconds (default: length of the audio file)')
+parser.add_argument('-F', '--fps', dest='fps', type=float, default=100.0, help='frame rate (default: 100)')
+parser.add_argument('-s', '--seed', dest='seed', type=int, default=0, help='seed for random generators (default: 0)')
+
+args = parser.parse_args()
+start = timer()
+frames = offline.render_config(args.config, args.output, duration=args.duration, fps=args.fps,
+                               audio_path=args.audio, sample_rate=args.sample_rate, num_channels=args.channels, seed=args.seed)
+elapsed = timer() - start
+print("Rendered {} frames in {:.2f}s ({:.1f} fps)".format(frames, elapsed, frames / elapsed if elapsed > 0 else 0.0))
@@ -11,7 +11,7 @@ import argparse
 import colorsys
 import numpy as np
 import os.path
-from flask import Flask, jsonify, abort, send_from_directory, request
+from flask import Flask, Response, jsonify, abort, send_from_directory, request
 from audioled import filtergraph
 from audioled import audio
 from audioled import effects
@@ -29,11 +29,12 @@ fg = None
 default_values = {}
 
 POOL_TIME = 0.001 #Seconds
+target_fps = 100.0
 
 # lock to control access to variable
 dataLock = threading.Lock()
 # thread handler
-ledThread = threading.Thread()
+ledThread = None
 event_loop = None
 # timing
 current_time = None
@@ -45,15 +46,139 @@ errors = []
 # def home():
 #     return app.send_static_file('index.html')
 
+
+class RenderLoop(threading.Thread):
+    """
+    Long-lived thread that renders frames at a fixed target rate.
+
+    The sleep between frames is computed from absolute deadlines, so scheduling
+    errors don't accumulate. Frames finishing after their deadline are counted
+    in missedDeadlines, the loop doesn't try to catch up on them.
+    """
+
+    def __init__(self, frame, fps=100.0, report_interval=10.0):
+        super(RenderLoop, self).__init__(name='LEDThread', daemon=True)
+        self._frame = frame
+        self.fps = fps
+        self.report_interval = report_interval
+        self.frameCount = 0
+        self.missedDeadlines = 0
+        self.lastFrameTime = 0.0
+        self.frameTiming = filtergraph.Timing()
+        self.intervalTiming = filtergraph.Timing()
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        deadline = timer()
+        last_report = deadline
+        reported_frames, reported_missed = 0, 0
+        last_start = None
+        while not self._stopEvent.is_set():
+            start = timer()
+            if last_start is not None:
+                self.intervalTiming.update(start - last_start)
+            last_start = start
+            self._frame()
+            end = timer()
+            self.lastFrameTime = end - start
+            self.frameTiming.update(self.lastFrameTime)
+            self.frameCount += 1
+            deadline += 1.0 / self.fps
+            if end > deadline:
+                # frame took too long, restart schedule from now
+                self.missedDeadlines += 1
+                deadline = end
+            if self.report_interval is not None and end - last_report > self.report_interval:
+                if self.missedDeadlines > reported_missed:
+                    print("LED thread missed {} of {} deadlines in the last {:.0f}s".format(
+                        self.missedDeadlines - reported_missed, self.frameCount - reported_frames, end - last_report))
+                last_report = end
+                reported_frames, reported_missed = self.frameCount, self.missedDeadlines
+            # always yield a little time to the other threads
+            self._stopEvent.wait(max(POOL_TIME, deadline - timer()))
+
+
+def collectMetrics():
+    """Collects render loop, filter graph, audio and device metrics"""
+    metrics = {'render_loop': None, 'graph': None, 'audio': None, 'devices': {}, 'errors': len(errors)}
+    if ledThread is not None:
+        interval = ledThread.intervalTiming._avg
+        metrics['render_loop'] = {
+            'target_fps': ledThread.fps,
+            'fps': 1.0 / interval if interval else 0.0,
+            'frames': ledThread.frameCount,
+            'missed_deadlines': ledThread.missedDeadlines,
+            'frame_time': ledThread.frameTiming.getStats(),
+        }
+    graph = fg
+    if graph is not None:
+        metrics['graph'] = graph.getTimings()
+        for node in list(graph._filterNodes):
+            if isinstance(node.effect, devices.LEDOutput):
+                metrics['devices'][node.uid] = node.effect.getShowTiming().getStats()
+    captures = list(audio.AudioInput.global_streams.values())
+    if captures:
+        metrics['audio'] = {'overflows': sum(capture.ring.overflowCount for capture in captures),
+                            'underruns': sum(capture.ring.underrunCount for capture in captures)}
+    return metrics
+
+
+def formatPrometheus(metrics):
+    """Formats metrics from collectMetrics in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, metricType, help, samples):
+        lines.append("# HELP audioled_{} {}".format(name, help))
+        lines.append("# TYPE audioled_{} {}".format(name, metricType))
+        for labels, value in samples:
+            labelText = ",".join('{}="{}"'.format(key, val) for key, val in labels)
+            lines.append("audioled_{}{} {}".format(name, "{" + labelText + "}" if labelText else "", value))
+
+    def quantiles(stats, labels=()):
+        return [(tuple(labels) + (('quantile', q),), stats[key]) for q, key in (("0.5", 'p50'), ("0.95", 'p95'), ("0.99", 'p99'), ("1", 'max'))
+                if key in stats]
+
+    loop = metrics['render_loop']
+    if loop is not None:
+        metric('target_fps', 'gauge', 'Target frame rate of the render loop', [((), loop['target_fps'])])
+        metric('fps', 'gauge', 'Measured frame rate of the render loop', [((), loop['fps'])])
+        metric('frames_total', 'counter', 'Frames rendered', [((), loop['frames'])])
+        metric('missed_deadlines_total', 'counter', 'Frames that finished after their deadline', [((), loop['missed_deadlines'])])
+        metric('frame_seconds', 'gauge', 'Render loop frame time', quantiles(loop['frame_time']))
+    graph = metrics['graph']
+    if graph is not None:
+        metric('graph_frame_seconds', 'gauge', 'Filter graph update and process time', quantiles(graph['frame']))
+        for kind in ('update', 'process'):
+            samples = []
+            for uid, stats in graph[kind].items():
+                samples.extend(quantiles(stats, (('node', uid), ('effect', stats['effect']))))
+            metric('node_{}_seconds'.format(kind), 'gauge', 'Time spent in {}() per node'.format(kind), samples)
+    samples = []
+    for uid, stats in metrics['devices'].items():
+        samples.extend(quantiles(stats, (('node', uid),)))
+    metric('device_show_seconds', 'gauge', 'Time spent sending pixels to the device', samples)
+    if metrics['audio'] is not None:
+        metric('audio_overflows_total', 'counter', 'Audio input overflows', [((), metrics['audio']['overflows'])])
+        metric('audio_underruns_total', 'counter', 'Audio reads without new samples', [((), metrics['audio']['underruns'])])
+    metric('node_errors', 'gauge', 'Nodes currently failing', [((), metrics['errors'])])
+    return "\n".join(lines) + "\n"
+
+
 def create_app():
     app = Flask(__name__,  static_url_path='/')
 
     def interrupt():
         print('cancelling LED thread')
         global ledThread
-        ledThread.cancel()
-        ledThread.join()
+        if ledThread is not None:
+            ledThread.stop()
         print('LED thread cancelled')
+        audio.AudioInput.close_streams()
 
     @app.after_request
     def add_header(response):
@@ -75,44 +200,57 @@ def create_app():
     @app.route('/node/<nodeUid>', methods=['GET'])
     def node_uid_get(nodeUid):
         global fg
-        try:
-            node = next(node for node in fg._filterNodes if node.uid == nodeUid)
-            return jsonpickle.encode(node)
-        except StopIteration:
-            abort(404,"Node not found")
+        node = fg.getNode(nodeUid)
+        if node is None:
+            abort(404, "Node not found")
+        return jsonpickle.encode(node)
 
     @app.route('/node/<nodeUid>', methods=['DELETE'])
     def node_uid_delete(nodeUid):
         global fg
-        try:
-            node = next(node for node in fg._filterNodes if node.uid == nodeUid)
+        with dataLock:
+            node = fg.getNode(nodeUid)
+            if node is None:
+                abort(404, "Node not found")
             fg.removeEffectNode(node.effect)
-            return "OK"
-        except StopIteration:
-            abort(404, "Node not found")
+        return "OK"
 
     @app.route('/node/<nodeUid>', methods=['UPDATE'])
     def node_uid_update(nodeUid):
         global fg
         if not request.json:
             abort(400)
-        try:
-            node = next(node for node in fg._filterNodes if node.uid == nodeUid)
-            #data =  json.loads(request.json)
-            print(request.json)
+        #data =  json.loads(request.json)
+        print(request.json)
+        with dataLock:
+            node = fg.getNode(nodeUid)
+            if node is None:
+                abort(404, "Node not found")
             node.effect.updateParameter(request.json)
-            return jsonpickle.encode(node)
-        except StopIteration:
-            abort(404, "Node not found")
+        return jsonpickle.encode(node)
 
     @app.route('/node/<nodeUid>/parameter', methods=['GET'])
     def node_uid_parameter_get(nodeUid):
         global fg
-        try:
-            node = next(node for node in fg._filterNodes if node.uid == nodeUid)
-            return json.dumps(node.effect.getParameter())
-        except StopIteration:
+        node = fg.getNode(nodeUid)
+        if node is None:
             abort(404, "Node not found")
+        return json.dumps(node.effect.getParameter())
+
+    @app.route('/node/<nodeUid>/rate', methods=['UPDATE'])
+    def node_uid_rate_update(nodeUid):
+        global fg
+        if not isinstance(request.json, dict) or 'rate' not in request.json:
+            abort(400, "Expected {'rate': <rate in Hz or null>}")
+        with dataLock:
+            node = fg.getNode(nodeUid)
+            if node is None:
+                abort(404, "Node not found")
+            try:
+                fg.setNodeRate(nodeUid, request.json['rate'])
+            except ValueError as e:
+                abort(400, str(e))
+        return jsonpickle.encode(node)
 
     @app.route('/node', methods=['POST'])
     def node_post():
@@ -129,7 +267,8 @@ def create_app():
             abort(403)
         class_ = getattr(importlib.import_module(module_name), class_name)
         instance = class_(**parameters)
-        node = fg.addEffectNode(instance)
+        with dataLock:
+            node = fg.addEffectNode(instance)
         return jsonpickle.encode(node)
 
     @app.route('/connections', methods=['GET'])
@@ -144,19 +283,26 @@ def create_app():
         if not request.json:
             abort(400)
         json = request.json
-        connection = fg.addNodeConnection(json['from_node_uid'], int(json['from_node_channel']), json['to_node_uid'], int(json['to_node_channel']))
+        fromUid, toUid = json['from_node_uid'], json['to_node_uid']
+        with dataLock:
+            if fg.getNode(fromUid) is None or fg.getNode(toUid) is None:
+                abort(404, "Node not found")
+            try:
+                connection = fg.addNodeConnection(fromUid, int(json['from_node_channel']), toUid, int(json['to_node_channel']))
+            except (filtergraph.NodeException, RuntimeError) as e:
+                # inconsistent buffer specs or a cycle
+                abort(400, str(e))
         
         return jsonpickle.encode(connection)
 
     @app.route('/connection/<connectionUid>', methods=['DELETE'])
     def connection_uid_delete(connectionUid):
         global fg
-        try:
-            connection = next(connection for connection in fg._filterConnections if connection.uid == connectionUid)
-            fg.removeConnection(connection.fromNode.effect, connection.fromChannel, connection.toNode.effect, connection.toChannel)
-            return "OK"
-        except StopIteration:
-            abort(404, "Node not found")
+        with dataLock:
+            if fg.getConnection(connectionUid) is None:
+                abort(404, "Connection not found")
+            fg.removeNodeConnection(connectionUid)
+        return "OK"
 
     @app.route('/effects', methods=['GET'])
     def effects_get():
@@ -214,6 +360,13 @@ def create_app():
             result[error.node.uid] = error.message
         return json.dumps(result)
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics_get():
+        metrics = collectMetrics()
+        if request.args.get('format') == 'json':
+            return json.dumps(metrics)
+        return Response(formatPrometheus(metrics), mimetype='text/plain; version=0.0.4')
+
     @app.route('/configuration', methods=['GET'])
     def configuration_get():
         config = jsonpickle.encode(fg)
@@ -224,7 +377,10 @@ def create_app():
         global fg
         if not request.json:
             abort(400)
-        fg = jsonpickle.decode(request.json)
+        newFg = jsonpickle.decode(request.json)
+        with dataLock:
+            oldFg, fg = fg, newFg
+            oldFg.close()
         return "OK"
 
     @app.route('/remote/brightness', methods=['POST'])
@@ -242,8 +398,11 @@ def create_app():
         global fg
         if os.path.isfile(filename):
             with open(filename,"r") as f:
-                fg = jsonpickle.decode(f.read())
-                return "OK"
+                newFg = jsonpickle.decode(f.read())
+            with dataLock:
+                oldFg, fg = fg, newFg
+                oldFg.close()
+            return "OK"
         else:
             print("Favorite not found: {}".format(filename))
         
@@ -254,7 +413,6 @@ def create_app():
     
     def processLED():
         global fg
-        global ledThread
         global event_loop
         global last_time
         global current_time
@@ -280,13 +438,6 @@ def create_app():
             errors.append(ne)
         except Exception as e:
             print("Unknown error: {}".format(e))
-        finally:
-            #fg.printProcessTimings()
-            # Set the next thread to happen
-            real_process_time = timer() - current_time
-            timeToWait = max(POOL_TIME, 0.01-real_process_time)
-            ledThread = threading.Timer(timeToWait, processLED, ())
-            ledThread.start()   
 
     def startLEDThread():
         # Do initialisation stuff here
@@ -295,7 +446,7 @@ def create_app():
         global current_time
         # Create your thread
         current_time = timer()
-        ledThread = threading.Timer(POOL_TIME, processLED, ())
+        ledThread = RenderLoop(processLED, fps=target_fps)
         print('starting LED thread')
         ledThread.start()
 
@@ -343,9 +494,11 @@ if __name__ == '__main__':
     parser.add_argument('-D', '--device', dest='device', default=deviceCandy, choices=[deviceRasp,deviceCandy], help = 'device to send RGB to')
     parser.add_argument('--device_candy_server', dest='device_candy_server', default='127.0.0.1:7890', help = 'Server for device FadeCandy')
     parser.add_argument('-A', '--audio_device_index', dest='audio_device_index', type=int, default=None, help='Audio device index to use')
+    parser.add_argument('-F', '--fps', dest='fps', type=float, default=100.0, help='target frame rate of the LED thread (default: 100)')
 
     args = parser.parse_args()
     num_pixels = args.num_pixels
+    target_fps = args.fps
     # Initialize LED device
     if args.device == deviceRasp:
         device = devices.RaspberryPi(num_pixels)
@@ -0,0 +1,108 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from audioled import audio
+from audioled import filtergraph
+
+
+class MockCapture(object):
+    def __init__(self):
+        self.ring = audio.AudioRingBuffer(64, 2)
+        self.chunk_length = 4
+        self.sample_rate = 240
+        self.readers = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Test_Audio(unittest.TestCase):
+
+    def test_ringBuffer_readsEveryFrameOnce(self):
+        ring = audio.AudioRingBuffer(8, 2)
+        reader = ring.reader()
+        out = np.ones((2, 2), dtype=np.float32)
+        # nothing captured yet, out is left as it is
+        self.assertFalse(reader.read(out))
+        np.testing.assert_array_equal(out, np.ones((2, 2)))
+        self.assertEqual(ring.underrunCount, 1)
+        frames = np.arange(0, 20, dtype=np.float32).reshape(-1, 2)
+        ring.write(frames[0:3])
+        self.assertTrue(reader.read(out))
+        np.testing.assert_array_equal(out, frames[0:2])
+        # only one unread frame
+        self.assertFalse(reader.read(out))
+        np.testing.assert_array_equal(out, frames[0:2])
+        self.assertEqual(ring.underrunCount, 2)
+        ring.write(frames[3:5])
+        self.assertTrue(reader.read(out))
+        np.testing.assert_array_equal(out, frames[2:4])
+        # wraps around
+        ring.write(frames[5:7])
+        self.assertTrue(reader.read(out))
+        np.testing.assert_array_equal(out, frames[4:6])
+        ring.write(frames[7:9])
+        self.assertTrue(reader.read(out))
+        np.testing.assert_array_equal(out, frames[6:8])
+
+    def test_ringBuffer_readerSkipsToLatestChunkWhenBehind(self):
+        ring = audio.AudioRingBuffer(8, 1)
+        reader = ring.reader()
+        out = np.zeros((2, 1), dtype=np.float32)
+        ring.write(np.arange(0, 7, dtype=np.float32).reshape(-1, 1))
+        self.assertTrue(reader.read(out))
+        np.testing.assert_array_equal(out[:, 0], [5, 6])
+        self.assertFalse(reader.read(out))
+
+    def test_ringBuffer_readersHaveOwnPosition(self):
+        ring = audio.AudioRingBuffer(8, 1)
+        first, second = ring.reader(), ring.reader()
+        out = np.zeros((2, 1), dtype=np.float32)
+        ring.write(np.arange(0, 2, dtype=np.float32).reshape(-1, 1))
+        for reader in (first, second):
+            self.assertTrue(reader.read(out))
+            np.testing.assert_array_equal(out[:, 0], [0, 1])
+
+    def test_audioInput_outputsNoneWithoutNewAudio(self):
+        chunk = np.arange(0, 8, dtype=np.float32).reshape(-1, 2)
+        override = audio.AudioInput.overrideSource
+        audio.AudioInput.overrideSource = lambda chunk_rate, channels: (iter([chunk, None]), 4 * chunk_rate)
+        try:
+            effect = audio.AudioInput(num_channels=2)
+        finally:
+            audio.AudioInput.overrideSource = override
+        effect._outputBuffer = [None, None]
+        filtergraph._runSync(effect.update(0.1))
+        effect.process()
+        np.testing.assert_array_equal(effect._outputBuffer[1], [1, 3, 5, 7])
+        filtergraph._runSync(effect.update(0.1))
+        effect.process()
+        self.assertEqual(effect._outputBuffer, [None, None])
+
+    def test_audioInput_closesCaptureWithLastReader(self):
+        capture = MockCapture()
+        audio.AudioInput.global_streams[(0, 2, 60)] = capture
+        self.addCleanup(audio.AudioInput.global_streams.clear)
+        fg = filtergraph.FilterGraph()
+        first = audio.AudioInput(device_index=0, num_channels=2)
+        second = audio.AudioInput(device_index=0, num_channels=2)
+        fg.addEffectNode(first)
+        self.assertEqual(capture.readers, 2)
+        # unchanged configuration keeps the capture
+        first.updateParameter({'autogain': True})
+        self.assertEqual(capture.readers, 2)
+        fg.removeEffectNode(first)
+        self.assertFalse(capture.closed)
+        mono = MockCapture()
+        audio.AudioInput.global_streams[(0, 1, 60)] = mono
+        second.updateParameter({'num_channels': 1})
+        self.assertTrue(capture.closed)
+        self.assertEqual(list(audio.AudioInput.global_streams.values()), [mono])
+        audio.AudioInput.close_streams()
+        self.assertTrue(mono.closed)
+        self.assertEqual(audio.AudioInput.global_streams, {})
+
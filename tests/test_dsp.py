@@ -53,6 +53,63 @@ class TestDSP(unittest.TestCase):
     #     validation = np.array([[1, 2, 3], [3, 4, 5], [5, 6, 7], [7, 8, 9]])
     #     self.assertTrue((list(dsp.rollwin(data_in, 0.5)) == validation).all())
 
+    def test_rollwin_matchesShiftedWindow(self):
+        """Verify the ring buffer window against shifting the whole window"""
+        chunks = [np.arange(i * 5, i * 5 + 5, dtype=float) for i in range(0, 9)]
+        expected = np.zeros(15)
+        expected[-5:] = chunks[0]
+        for data, window in zip(chunks[1:], dsp.rollwin(iter(chunks), 3)):
+            expected[:-5] = expected[5:]
+            expected[-5:] = data
+            np.testing.assert_array_equal(window, expected)
+
+    def test_hannRollwin_appliesWindowAndPadding(self):
+        chunks = [np.random.normal(size=6) for i in range(0, 7)]
+        expected = np.zeros(18)
+        hanning = np.hanning(18)
+        for data, window in zip(chunks, dsp.hann_rollwin(iter(chunks), 3)):
+            expected[:-6] = expected[6:]
+            expected[-6:] = data
+            self.assertEqual(len(window), 32)
+            np.testing.assert_array_equal(window[:18], expected * hanning)
+            self.assertTrue((window[18:] == 0).all())
+
+    def test_rms(self):
+        y = np.array([3.0, -4.0, 0.0, 1.0])
+        self.assertAlmostEqual(dsp.rms(y), np.sqrt(26.0 / 2))
+        self.assertAlmostEqual(dsp.rms(list(y)), np.sqrt(26.0 / 2))
+        channels = np.stack([y, 2 * y], axis=1).astype(np.float32)
+        np.testing.assert_allclose(dsp.rms(channels, axis=0), [np.sqrt(26.0 / 2), np.sqrt(104.0 / 2)])
+
+    def test_filterBank_matchesTriangles(self):
+        for scale in ('mel', 'bark'):
+            filters, f_hz = dsp.filter_bank(16, 256, 12000, 30.0, 6000.0, scale)
+            bins = np.floor(257. * np.r_[30.0, f_hz, 6000.0] / 12000)
+            expected = np.zeros((16, 129))
+            for m in range(1, 17):
+                for k in range(int(bins[m - 1]), int(bins[m])):
+                    expected[m - 1, k] = (k - bins[m - 1]) / (bins[m] - bins[m - 1])
+                for k in range(int(bins[m]), int(bins[m + 1])):
+                    expected[m - 1, k] = (bins[m + 1] - k) / (bins[m + 1] - bins[m])
+            np.testing.assert_allclose(filters, expected)
+
+    def test_warpPsd_usesCachedSparseBank(self):
+        spectrum = np.random.rand(513)
+        filters, f = dsp.filter_bank(64, 1024, 12000, 261.0, 6000, 'bark')
+        warped = dsp.warp_psd(spectrum, 1024, 64, 12000, [261.0, 6000], 'bark')
+        np.testing.assert_allclose(warped, np.dot(spectrum, filters.T))
+        self.assertIs(dsp.sparse_filter_bank(64, 1024, 12000, 261.0, 6000, 'bark'),
+                      dsp.sparse_filter_bank(64.0, 1024, 12000.0, 261, 6000.0, 'bark'))
+
+    def test_powerSpectrum_reusesOutput(self):
+        for workers in (None, 2):
+            psd = dsp.PowerSpectrum(64, workers=workers)
+            for i in range(0, 3):
+                y = np.random.normal(size=48)
+                out = psd.compute(y)
+                self.assertIs(out, psd.output)
+                np.testing.assert_allclose(out, dsp.power_spectrum(np.r_[y, np.zeros(16)]), rtol=1e-10, atol=1e-12)
+
     def test_downsample(self):
         chunks = 3  # Number of chunks in signal
         samples = 5  # Number of samples per chunk
@@ -79,6 +136,68 @@ class TestDSP(unittest.TestCase):
         self.assertEqual(ds_samples, (samples + (samples % 2)) // 2)
         self.assertEqual(len(ds_signal), chunks)
 
+    def test_decimator_carriesStateAcrossChunks(self):
+        from scipy.signal import lfilter
+        x = np.random.normal(size=1000)
+        decimator = dsp.Decimator(4)
+        y = np.concatenate([decimator.process(chunk) for chunk in np.split(x, [7, 300, 301, 302, 777])])
+        expected = lfilter(decimator._taps[::-1], 1.0, x)[::4]
+        np.testing.assert_allclose(y, expected)
+
+    def test_decimate_suppressesAliasing(self):
+        fs = 48000
+        t = np.arange(0, 9600) / fs
+        # 10 kHz is above the Nyquist frequency of the decimated signal
+        signal = (chunk for chunk in np.split(np.sin(2 * np.pi * 10000 * t), 12))
+        ds_signal, ds_fs = dsp.decimate(signal, fs=fs, fmax=6000)
+        self.assertEqual(ds_fs, 12000)
+        y = np.concatenate(list(ds_signal))
+        self.assertEqual(len(y), 2400)
+        self.assertLess(dsp.rms(y[200:]), 0.01)
+
+    def test_sosFilter_matchesLfilter(self):
+        from scipy.signal import lfilter
+        x = np.random.normal(size=(4, 200))
+        b, a, zi = dsp.design_filter(100.0, 300.0, 48000, 3)
+        expected = lfilter(b, a, x.ravel(), zi=np.zeros_like(zi))[0]
+        sos, zi = dsp.design_filter(100.0, 300.0, 48000, 3, output='sos')
+        bandpass = dsp.SOSFilter(sos, np.zeros_like(zi))
+        y = np.concatenate([bandpass.process(chunk) for chunk in x])
+        np.testing.assert_allclose(y, expected, atol=1e-5)
+
+    def test_onsetDetector_findsBeatsAndTempo(self):
+        np.random.seed(0)
+        detector = dsp.OnsetDetector(frame_rate=60.0)
+        onsets = []
+        beats = []
+        for i in range(0, 900):
+            spectrum = 1e-4 * np.random.rand(513)
+            if i % 24 == 0 and i < 600:
+                # click every 0.4 s, 150 bpm
+                spectrum += 1.0
+            flux, onset, beat = detector.process(spectrum)
+            if onset:
+                onsets.append(i)
+            if beat:
+                beats.append(i)
+        # the threshold needs 0.5 s of flux history
+        self.assertEqual(onsets, list(range(48, 600, 24)))
+        self.assertAlmostEqual(detector.bpm, 150.0, delta=1.0)
+        # beats continue with the tempo after the clicks stop
+        self.assertEqual(beats, list(range(48, 900, 24)))
+
+    def test_onsetDetector_followsFrameRate(self):
+        np.random.seed(0)
+        # the first frame came late, the graph runs at 60 fps
+        detector = dsp.OnsetDetector(frame_rate=20.0)
+        for i in range(0, 900):
+            spectrum = 1e-4 * np.random.rand(513)
+            if i % 24 == 0:
+                spectrum += 1.0
+            detector.process(spectrum, 1.0 / 60.0)
+        self.assertAlmostEqual(detector.frame_rate, 60.0, delta=1.0)
+        self.assertAlmostEqual(detector.bpm, 150.0, delta=3.0)
+
     def test_pad_zeros(self):
         chunks = 7
         samples = 6
@@ -2,9 +2,15 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import concurrent.futures
 import unittest
 import numpy as np
+import asyncio
+import jsonpickle
 from audioled import filtergraph 
+from audioled import colors
+from audioled import effects
+from audioled.effect import Effect, BufferSpec
 
 
 
@@ -36,6 +42,50 @@ class Test_FilterGraph(unittest.TestCase):
         fg.removeConnection(ef1,0,ef2,0)
         self.assertEqual(len(fg._filterConnections),0)
 
+    def test_nodesAndConnections_canBeFoundByUid(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        n1 = fg.addEffectNode(ef1)
+        n2 = fg.addEffectNode(ef2)
+        con = fg.addNodeConnection(n1.uid,0,n2.uid,0)
+        self.assertIs(fg.getNode(n1.uid), n1)
+        self.assertIs(fg.getNodeForEffect(ef2), n2)
+        self.assertIs(fg.getConnection(con.uid), con)
+
+        fg.removeNodeConnection(con.uid)
+        self.assertIsNone(fg.getConnection(con.uid))
+        self.assertEqual(len(n2._incomingConnections),0)
+        fg.removeEffectNode(ef1)
+        self.assertIsNone(fg.getNode(n1.uid))
+        self.assertIsNone(fg.getNodeForEffect(ef1))
+
+    def test_bufferPool_recyclesArrays(self):
+        pool = filtergraph.BufferPool()
+        a = pool.get((3, 10))
+        self.assertEqual(a.dtype, np.float32)
+        pool.put(a)
+        self.assertIs(pool.get((3, 10)), a)
+        self.assertIsNot(pool.get((3, 10)), a)
+
+    def test_bufferPool_handsOutArraysOnceAcrossThreads(self):
+        pool = filtergraph.BufferPool()
+        arrays = [np.empty((3, 10), dtype=np.float32) for i in range(0, 400)]
+        for a in arrays:
+            pool.put(a)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            taken = list(executor.map(lambda i: pool.get((3, 10)), range(0, 500)))
+        self.assertEqual(len(set(id(a) for a in taken)), 500)
+        self.assertEqual(len(set(id(a) for a in taken) & set(id(a) for a in arrays)), 400)
+
+    def test_removeEffectNode_releasesOutputArrays(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockUpdateEffect()
+        fg.addEffectNode(ef1)
+        out = ef1._getOutputArray(0, (3, 10))
+        fg.removeEffectNode(ef1)
+        self.assertIs(fg._bufferPool.get((3, 10)), out)
+
     def test_connectionOrder_ok(self):
         fg = filtergraph.FilterGraph()
         ef1 = MockEffect()
@@ -55,6 +105,25 @@ class Test_FilterGraph(unittest.TestCase):
         self.assertTrue(fg._processOrder.index(n1) < fg._processOrder.index(n3))
         self.assertTrue(fg._processOrder.index(n2) < fg._processOrder.index(n3))
 
+    def test_connectionOrder_afterRemovingNodes_ok(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        ef3 = MockEffect()
+        ef4 = MockEffect()
+        n1 = fg.addEffectNode(ef1)
+        fg.addEffectNode(ef2)
+        n3 = fg.addEffectNode(ef3)
+        fg.addConnection(ef3,0,ef1,0)
+        fg.removeEffectNode(ef2)
+        n4 = fg.addEffectNode(ef4)
+        fg.addConnection(ef4,0,ef3,0)
+
+        self.assertEqual(fg._processOrder, [n4, n3, n1])
+        self.assertEqual(len(fg._filterNodes), 3)
+        self.assertEqual(len(n3._incomingConnections), 1)
+        self.assertEqual(len(n3._outgoingConnections), 1)
+
     def test_removeNodes_connectionsAreRemove(self):
         fg = filtergraph.FilterGraph()
         ef1 = MockEffect()
@@ -77,11 +146,44 @@ class Test_FilterGraph(unittest.TestCase):
         fg.addConnection(ef1,0,ef2,0)
         fg.addConnection(ef2,0,ef3,0)
         self.assertRaises(RuntimeError, fg.addConnection, ef3,0,ef1,0)
+        # failed connection is not kept
+        self.assertEqual(len(fg._filterConnections),2)
+
+    def test_selfConnection_raisesError(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        fg.addEffectNode(ef1)
+        self.assertRaises(RuntimeError, fg.addConnection, ef1,0,ef1,1)
+        self.assertEqual(len(fg._filterConnections),0)
+        # graph is still usable and can be saved
+        fg.addEffectNode(MockEffect())
+        fg2 = jsonpickle.decode(jsonpickle.encode(fg))
+        self.assertEqual(len(fg2._filterNodes),2)
+
+    def test_setstate_restoresNodesAndOrder(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        ef3 = MockEffect()
+        # add in reverse order to force sorting
+        n3 = fg.addEffectNode(ef3)
+        n2 = fg.addEffectNode(ef2)
+        n1 = fg.addEffectNode(ef1)
+        fg.addConnection(ef2,0,ef3,0)
+        fg.addConnection(ef1,0,ef2,0)
+
+        newFg = filtergraph.FilterGraph.__new__(filtergraph.FilterGraph)
+        newFg.__setstate__(fg.__getstate__())
+        self.assertEqual([node.uid for node in newFg._processOrder], [n1.uid, n2.uid, n3.uid])
+        self.assertEqual(len(newFg._filterConnections), 2)
 
     def test_outputBuffer_works(self):
         fg = filtergraph.FilterGraph()
         ef1 = MockEffect()
+        sink = MockSink()
         fg.addEffectNode(ef1)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
         fg.process()
         self.assertEqual(len(fg._filterNodes[0]._outputBuffer), 5)
         self.assertEqual(fg._filterNodes[0]._outputBuffer[0], 0)
@@ -89,7 +191,10 @@ class Test_FilterGraph(unittest.TestCase):
     def test_mockEffect_works(self):
         fg = filtergraph.FilterGraph()
         ef1 = MockEffect()
+        sink = MockSink()
         n1 = fg.addEffectNode(ef1)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
         ef1._inputBuffer[0] = 'test'
         ef1.process()
         self.assertEqual(ef1._outputBuffer[0], 'test')
@@ -105,15 +210,256 @@ class Test_FilterGraph(unittest.TestCase):
         ef1 = MockEffect()
         ef2 = MockEffect()
 
+        sink = MockSink()
+
         n1 = fg.addEffectNode(ef1)
         n2 = fg.addEffectNode(ef2)
+        fg.addEffectNode(sink)
         fg.addConnection(ef1,0,ef2,1)
+        fg.addConnection(ef2,1,sink,0)
 
         n1._inputBuffer[0] = 'test'
         fg.process()
 
         self.assertEqual(n1._outputBuffer[0], 'test')
         self.assertEqual(n2._outputBuffer[1], 'test')
+        self.assertEqual(sink._inputBuffer[0], 'test')
+
+    def test_parallelProcessing_works(self):
+        fg = filtergraph.FilterGraph(parallelProcessing=True)
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        ef3 = MockEffect()
+        sink = MockSink()
+        n1 = fg.addEffectNode(ef1)
+        n2 = fg.addEffectNode(ef2)
+        n3 = fg.addEffectNode(ef3)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,ef3,0)
+        fg.addConnection(ef2,1,ef3,1)
+        fg.addConnection(ef3,1,sink,0)
+
+        n1._inputBuffer[0] = 'test'
+        fg.process()
+        self.assertEqual(n3._outputBuffer[0], 'test')
+        self.assertEqual(sink._inputBuffer[0], 1)
+        # independent nodes end up in the same level
+        levels = [[step[0] for step in level] for level in fg._executionLevels]
+        self.assertEqual(levels[0], [n1, n2])
+        self.assertEqual(levels[1], [n3])
+
+    def test_parallelProcessing_raisesNodeException(self):
+        fg = filtergraph.FilterGraph(parallelProcessing=True)
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        sink = MockSink()
+        fg.addEffectNode(ef1)
+        n2 = fg.addEffectNode(ef2)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
+        fg.addConnection(ef2,0,sink,0)
+        ef2._outputBuffer = None
+        with self.assertRaises(filtergraph.NodeException) as context:
+            fg.process()
+        self.assertIs(context.exception.node, n2)
+
+    def test_update_runsSyncAndAsyncEffects(self):
+        fg = filtergraph.FilterGraph()
+        syncEffect = MockUpdateEffect()
+        asyncEffect = MockAsyncUpdateEffect()
+        fg.addEffectNode(syncEffect)
+        fg.addEffectNode(asyncEffect)
+        fg.update(0.5, asyncio.new_event_loop())
+        self.assertEqual(syncEffect._t, 0.5)
+        self.assertEqual(asyncEffect._t, 0.5)
+        self.assertEqual(len(fg._syncUpdates), 1)
+        self.assertEqual(fg._asyncUpdates, [(fg.getNodeForEffect(asyncEffect), asyncEffect)])
+
+    def test_update_undeclaredAsyncWork_raisesNodeException(self):
+        fg = filtergraph.FilterGraph()
+        effect = MockAsyncUpdateEffect()
+        effect.needsAsyncUpdate = lambda: False
+        fg.addEffectNode(effect)
+        self.assertRaises(filtergraph.NodeException, fg.update, 0.5)
+
+    def test_nodesWithoutConsumers_arePruned(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        ef2 = MockEffect()
+        sink = MockSink()
+        n1 = fg.addEffectNode(ef1)
+        n2 = fg.addEffectNode(ef2)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
+
+        fg.process()
+        self.assertEqual(n1._outputBuffer[0], 0)
+        self.assertIsNone(n2._outputBuffer[0])
+
+        # plan is recompiled after connection changes
+        fg.addConnection(ef2,0,ef1,0)
+        fg.process()
+        self.assertEqual(n2._outputBuffer[0], 0)
+
+    def test_removeConnection_clearsInput(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockEffect()
+        sink = MockSink()
+        fg.addEffectNode(ef1)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,1,sink,0)
+        fg.process()
+        self.assertEqual(sink._inputBuffer[0], 1)
+        fg.removeConnection(ef1,1,sink,0)
+        fg.process()
+        self.assertIsNone(sink._inputBuffer[0])
+
+    def test_specs_arePropagated(self):
+        fg = filtergraph.FilterGraph()
+        col = colors.StaticRGBColor(num_pixels=10)
+        append = effects.Append(num_channels=2)
+        mirror = effects.Mirror()
+        fg.addEffectNode(col)
+        fg.addEffectNode(append)
+        n3 = fg.addEffectNode(mirror)
+        fg.addConnection(col,0,append,0)
+        fg.addConnection(col,0,append,1)
+        fg.addConnection(append,0,mirror,0)
+        self.assertEqual(n3._outputSpecs, [BufferSpec((3, 20), np.float32)])
+        self.assertEqual(mirror._inputSpecs, [BufferSpec((3, 20), np.float32)])
+
+    def test_inconsistentSpecs_raiseNodeException(self):
+        fg = filtergraph.FilterGraph()
+        col1 = colors.StaticRGBColor(num_pixels=10)
+        col2 = colors.StaticRGBColor(num_pixels=20)
+        interp = colors.InterpolateRGB(num_pixels=10)
+        fg.addEffectNode(col1)
+        fg.addEffectNode(col2)
+        fg.addEffectNode(interp)
+        fg.addConnection(col1,0,interp,0)
+        self.assertRaises(filtergraph.NodeException, fg.addConnection, col2,0,interp,1)
+        # failed connection is not kept
+        self.assertEqual(len(fg._filterConnections),1)
+
+    def test_dtypeMismatch_raisesNodeException(self):
+        fg = filtergraph.FilterGraph()
+        col = colors.StaticRGBColor(num_pixels=10)
+        source = MockSpecEffect(BufferSpec((3, 10), np.complex128))
+        interp = colors.InterpolateRGB(num_pixels=10)
+        fg.addEffectNode(col)
+        fg.addEffectNode(source)
+        fg.addEffectNode(interp)
+        fg.addConnection(col,0,interp,0)
+        self.assertRaises(filtergraph.NodeException, fg.addConnection, source,0,interp,1)
+        self.assertEqual(len(fg._filterConnections),1)
+
+    def test_staticNodes_areFolded(self):
+        fg = filtergraph.FilterGraph()
+        static = MockStaticEffect()
+        sink = MockUpdateSink()
+        fg.addEffectNode(static)
+        fg.addEffectNode(sink)
+        fg.addConnection(static,0,sink,0)
+        for i in range(0,3):
+            fg.update(0.01)
+            fg.process()
+        self.assertEqual(static.numProcessed, 1)
+        self.assertEqual(sink._inputBuffer[0], 1)
+        # parameter change recompiles
+        static.updateParameter({})
+        fg.update(0.01)
+        fg.process()
+        fg.update(0.01)
+        fg.process()
+        self.assertEqual(static.numProcessed, 2)
+
+    def test_parameterChange_updatesSpecs(self):
+        fg = filtergraph.FilterGraph()
+        wheel = colors.ColorWheel(num_pixels=10)
+        mirror = effects.Mirror()
+        glow = effects.AfterGlow()
+        sink = MockUpdateSink()
+        for effect in (wheel, mirror, glow, sink):
+            fg.addEffectNode(effect)
+        fg.addConnection(wheel,0,mirror,0)
+        fg.addConnection(mirror,0,glow,0)
+        fg.addConnection(glow,0,sink,0)
+        fg.update(0.1)
+        fg.process()
+        wheel.updateParameter({'num_pixels': 20})
+        for i in range(0, 2):
+            fg.update(0.1)
+            fg.process()
+        self.assertEqual(fg.getNodeForEffect(wheel)._outputSpecs[0].shape, (3, 20))
+        self.assertEqual(sink._inputBuffer[0].shape, (3, 20))
+
+    def test_nodeRate_holdsOutputs(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockCountingEffect()
+        sink = MockUpdateSink()
+        n1 = fg.addEffectNode(ef1)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
+        fg.setNodeRate(n1.uid, 1.0)
+        for i in range(0,10):
+            fg.update(0.25)
+            fg.process()
+        self.assertEqual(ef1.numProcessed, 3)
+        self.assertEqual(sink._inputBuffer[0], 3)
+        # update gets the time since the last run
+        self.assertEqual(ef1._t, 2.0)
+        for rate in (0, -1.0, float('nan'), '10', True, [1.0]):
+            self.assertRaises(ValueError, fg.setNodeRate, n1.uid, rate)
+        # rate is kept
+        fg2 = jsonpickle.decode(jsonpickle.encode(fg))
+        self.assertEqual(fg2.getNode(n1.uid).rate, 1.0)
+
+    def test_nodeRate_keepsTimingWhenGraphChanges(self):
+        fg = filtergraph.FilterGraph()
+        ef1 = MockCountingEffect()
+        ef2 = MockCountingEffect()
+        sink = MockUpdateSink()
+        n1 = fg.addEffectNode(ef1)
+        fg.addEffectNode(ef2)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
+        fg.setNodeRate(n1.uid, 1.0)
+        for i in range(0,100):
+            if i % 5 == 0:
+                # parameter change of another effect recompiles the graph
+                ef2.updateParameter({})
+            fg.update(0.1)
+            fg.process()
+        self.assertEqual(ef1.numProcessed, 10)
+        # first run after 0.1 s, then once per second
+        self.assertAlmostEqual(ef1._t, 9.1)
+
+    def test_timing_computesPercentilesOverWindow(self):
+        timing = filtergraph.Timing(window=100)
+        for i in range(0, 200):
+            timing.update(float(i))
+        stats = timing.getStats()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['max'], 199.0)
+        self.assertAlmostEqual(stats['avg'], 149.5)
+        self.assertAlmostEqual(stats['p50'], 149.5)
+        self.assertAlmostEqual(stats['p99'], 198.01)
+        self.assertEqual(timing._min, 0.0)
+
+    def test_recordTimings_collectsUpdateProcessAndFrame(self):
+        fg = filtergraph.FilterGraph(recordTimings=True)
+        ef1 = MockCountingEffect()
+        sink = MockUpdateSink()
+        n1 = fg.addEffectNode(ef1)
+        fg.addEffectNode(sink)
+        fg.addConnection(ef1,0,sink,0)
+        for i in range(0,3):
+            fg.update(0.01)
+            fg.process()
+        timings = fg.getTimings()
+        self.assertEqual(timings['frame']['count'], 3)
+        self.assertEqual(timings['update'][n1.uid]['count'], 3)
+        self.assertEqual(timings['process'][n1.uid]['effect'], 'MockCountingEffect')
 
 
 class MockEffect(object):
@@ -142,4 +488,74 @@ class MockEffect(object):
 
         for i in range(0,5):
             if self._inputBuffer[i] != None:
-                self._outputBuffer[i] = self._inputBuffer[i]
\ No newline at end of file
+                self._outputBuffer[i] = self._inputBuffer[i]
+
+
+class MockSink(MockEffect):
+
+    def numOutputChannels(self):
+        return 0
+
+    def numInputChannels(self):
+        return 1
+
+    def process(self):
+        pass
+
+
+class MockUpdateEffect(Effect):
+
+    def numOutputChannels(self):
+        return 1
+
+    def numInputChannels(self):
+        return 0
+
+    def process(self):
+        pass
+
+
+class MockAsyncUpdateEffect(MockUpdateEffect):
+
+    def needsAsyncUpdate(self):
+        return True
+
+    async def update(self, dt):
+        await asyncio.sleep(0)
+        await super().update(dt)
+
+
+class MockCountingEffect(MockUpdateEffect):
+
+    def __init__(self):
+        self.numProcessed = 0
+        super().__init__()
+
+    def process(self):
+        self.numProcessed += 1
+        self._outputBuffer[0] = self.numProcessed
+
+
+class MockSpecEffect(MockUpdateEffect):
+
+    def __init__(self, spec):
+        self.spec = spec
+        super().__init__()
+
+    def inferOutputSpecs(self, inputSpecs):
+        return [self.spec]
+
+
+class MockStaticEffect(MockCountingEffect):
+
+    def isTimeInvariant(self):
+        return True
+
+
+class MockUpdateSink(MockUpdateEffect):
+
+    def numOutputChannels(self):
+        return 0
+
+    def numInputChannels(self):
+        return 1
@@ -0,0 +1,122 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import os
+import tempfile
+import unittest
+import numpy as np
+import scipy.io.wavfile
+import jsonpickle
+from audioled import audio
+from audioled import audioreactive
+from audioled import colors
+from audioled import devices
+from audioled import filtergraph
+from audioled import offline
+
+
+class Test_Offline(unittest.TestCase):
+
+    def test_fileAudioChunks_followClock(self):
+        samples = np.arange(0, 100, dtype=np.float32).reshape(-1, 1)
+        clock = offline.FixedClock(10)
+        chunks = audio.file_audio_chunks(samples, 100, chunk_rate=10, channels=2, clock=clock)
+        clock.tick()
+        np.testing.assert_array_equal(next(chunks)[0:2], [[0, 0], [1, 1]])
+        # the next chunk isn't complete yet
+        self.assertIsNone(next(chunks))
+        clock.tick()
+        clock.tick()
+        np.testing.assert_array_equal(next(chunks)[0:2], [[20, 20], [21, 21]])
+
+    def test_fileAudioChunks_scaleIntegerWav(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'audio.wav')
+        scipy.io.wavfile.write(path, 100, np.array([-32768, 0, 16384, 32767] * 5, dtype=np.int16))
+        samples, rate = audio.load_audio_file(path)
+        self.assertEqual(samples.dtype, np.int16)
+        chunk = next(audio.file_audio_chunks(samples, rate, chunk_rate=10))
+        self.assertEqual(chunk.dtype, np.float32)
+        np.testing.assert_allclose(chunk[0:4, 0], [-1.0, 0.0, 0.5, 32767 / 32768])
+        del samples
+
+    def test_fileAudioInput_realtimeFollowsGraphTime(self):
+        effect = audio.FileAudioInput(chunk_rate=10, num_channels=2)
+        samples = np.arange(0, 200, dtype=np.float32).reshape(-1, 2)
+        effect.setSamples(samples, 100)
+        effect._outputBuffer = [None, None]
+        filtergraph._runSync(effect.update(0.2))
+        effect.process()
+        np.testing.assert_array_equal(effect._outputBuffer[0], samples[10:20, 0])
+        np.testing.assert_array_equal(effect._outputBuffer[1], samples[10:20, 1])
+
+    def test_fileAudioInput_fastModeReadsConsecutiveChunks(self):
+        effect = audio.FileAudioInput(chunk_rate=10, num_channels=1, realtime=False, loop=False)
+        effect.setSamples(np.arange(0, 20, dtype=np.float32), 100)
+        effect._outputBuffer = [None]
+        for start in (0, 10):
+            filtergraph._runSync(effect.update(1.0))
+            effect.process()
+            np.testing.assert_array_equal(effect._outputBuffer[0], np.arange(start, start + 10))
+        # end of samples
+        filtergraph._runSync(effect.update(1.0))
+        effect.process()
+        self.assertIsNone(effect._outputBuffer[0])
+
+    def test_renderConfig_recordsFrames(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        configPath = os.path.join(tmp.name, 'config.json')
+        framePath = os.path.join(tmp.name, 'frames.bin')
+        fg = filtergraph.FilterGraph()
+        color = colors.StaticRGBColor(num_pixels=10, r=255.0, g=128.0, b=0.0)
+        output = devices.LEDOutput(devices.LEDController())
+        fg.addEffectNode(color)
+        fg.addEffectNode(output)
+        fg.addConnection(color, 0, output, 0)
+        with open(configPath, "w") as f:
+            f.write(jsonpickle.encode(fg))
+
+        self.assertEqual(offline.render_config(configPath, framePath, duration=0.5, fps=20.0), 10)
+        fps, frames = offline.read_frames(framePath)
+        self.assertEqual(fps, 20.0)
+        self.assertEqual(frames.shape, (10, 10, 3))
+        np.testing.assert_array_equal(frames[-1, 0], [255, 128, 0])
+        del frames
+
+    def test_renderConfig_recordsFramePerTick(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        configPath = os.path.join(tmp.name, 'config.json')
+        framePath = os.path.join(tmp.name, 'frames.bin')
+        audioPath = os.path.join(tmp.name, 'audio.wav')
+        # audio is shorter than the rendered duration
+        scipy.io.wavfile.write(audioPath, 48000, (0.5 * np.sin(np.arange(0, 9600) * 0.1)).astype(np.float32))
+        fg = filtergraph.FilterGraph()
+        # don't open the audio device when creating the graph
+        override = audio.AudioInput.overrideSource
+        audio.AudioInput.overrideSource = offline._file_source(np.zeros((800, 1)), 48000, offline.FixedClock(60.0))
+        try:
+            audioInput = audio.AudioInput(num_channels=1)
+        finally:
+            audio.AudioInput.overrideSource = override
+        vu = audioreactive.VUMeterRMS(num_pixels=10)
+        output = devices.LEDOutput(devices.LEDController())
+        fg.addEffectNode(audioInput)
+        fg.addEffectNode(vu)
+        fg.addEffectNode(output)
+        fg.addConnection(audioInput, 0, vu, 0)
+        fg.addConnection(vu, 0, output, 0)
+        with open(configPath, "w") as f:
+            f.write(jsonpickle.encode(fg))
+
+        duration, fps = 0.5, 60.0
+        numFrames = offline.render_config(configPath, framePath, duration=duration, fps=fps, audio_path=audioPath)
+        self.assertEqual(numFrames, round(duration * fps))
+        fps, frames = offline.read_frames(framePath)
+        self.assertEqual(frames.shape, (round(duration * fps), 10, 3))
+        # the last frame is held after the audio ended
+        np.testing.assert_array_equal(frames[-1], frames[-2])
+        del frames